@@ -0,0 +1,289 @@
+#!/usr/bin/python3.1 -OO
+"""An executable file for benchmarking the indexing and the searching on a
+synthetic corpus, the results are printed as JSON"""
+import unittest
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+import boolsearch
+import indexer
+import searcher
+
+ONSETS = ['', 'b', 'c', 'ch', 'cz', 'd', 'dz', 'g', 'k', 'l', 'ł', 'm', 'n', 'p',
+        'pr', 'r', 's', 'sz', 'st', 'śl', 't', 'w', 'wr', 'z', 'ż', 'zw', 'gr', 'kr']
+VOWELS = ['a', 'e', 'i', 'o', 'u', 'y', 'ą', 'ę', 'ó']
+CODAS = ['', '', '', 'k', 'n', 'r', 'sk', 'ś', 'ć', 'ń', 'ł', 'st']
+ENDINGS = ['', 'a', 'u', 'y', 'em', 'ami', 'ów', 'ach', 'owi', 'ie']
+STOP_WORDS = ['w', 'i', 'na', 'z', 'do', 'się', 'nie', 'jest', 'że', 'o']
+KINDS = ['cnf', 'negation', 'phrase']
+
+def make_lemmas(count, rng):
+    '''Returns count distinct Polish-like lemmas made of random syllables'''
+    lemmas = []
+    seen = set(STOP_WORDS)
+    while len(lemmas) < count:
+        lemma = ''.join(rng.choice(ONSETS) + rng.choice(VOWELS)
+                for _ in range(rng.randint(1, 3))) + rng.choice(CODAS)
+        if lemma not in seen:
+            seen.add(lemma)
+            lemmas.append(lemma)
+    return lemmas
+
+def zipf_weights(count, exponent):
+    '''Returns the cumulative Zipfian weights of count ranks'''
+    return list(itertools.accumulate(1.0 / (rank ** exponent)
+        for rank in range(1, count + 1)))
+
+def generate_corpus(data_file, morfologik_file, documents = 10000, words = 100,
+        lemmas = 5000, exponent = 1.0, seed = 1):
+    """Writes a synthetic corpus and a matching morfologik file.
+
+    Every lemma has a few inflected forms (some forms belong to two lemmas)
+    and the words of the documents are drawn from the forms with a Zipfian
+    distribution of the given exponent, the stop words being the most
+    frequent. Returns the forms from the most to the least frequent."""
+    rng = random.Random(seed)
+    bases = {}
+    for lemma in make_lemmas(lemmas, rng):
+        for ending in rng.sample(ENDINGS, rng.randint(2, 5)):
+            bases.setdefault(lemma + ending, []).append(lemma)
+    forms = sorted(bases)
+    rng.shuffle(forms)
+    forms = STOP_WORDS + forms
+
+    with open(morfologik_file, 'w', encoding = 'utf-8') as handle:
+        for form in sorted(bases):
+            handle.write(' '.join([form] + bases[form]) + '\n')
+
+    weights = zipf_weights(len(forms), exponent)
+    with open(data_file, 'w', encoding = 'utf-8') as handle:
+        for doc in range(1, documents + 1):
+            handle.write('##TITLE## Dokument %(doc)d\n' % {'doc': doc})
+            length = rng.randint(words // 2, words * 3 // 2)
+            text = rng.choices(forms, cum_weights = weights, k = length)
+            for start in range(0, length, 12):
+                line = text[start:start + 12]
+                line[0] = line[0].capitalize()
+                handle.write(' '.join(line) + '.\n')
+    return forms
+
+def generate_queries(kind, forms, count, exponent = 1.0, seed = 1, data_file = None):
+    """Generates a workload of queries of a kind.
+
+    The cnf queries are conjunctions of one to four alternatives of one to
+    three terms drawn with a Zipfian distribution, the negation ones have
+    every term negated with probability one half (and at least one negated
+    term), the phrase ones are two to four consecutive words of random
+    documents of the data file."""
+    rng = random.Random(seed)
+    if kind == 'phrase':
+        lines = [line.rstrip('.\n').lower().split(' ')
+                for line in open(data_file, encoding = 'utf-8')
+                if not line.startswith('##TITLE##')]
+        lines = [line for line in lines if len(line) >= 4]
+        queries = []
+        for _ in range(count):
+            line = rng.choice(lines)
+            length = rng.randint(2, 4)
+            start = rng.randint(0, len(line) - length)
+            queries.append('"' + ' '.join(line[start:start + length]) + '"')
+        return queries
+
+    weights = zipf_weights(len(forms), exponent)
+    queries = []
+    for _ in range(count):
+        clauses = [rng.choices(forms, cum_weights = weights, k = rng.randint(1, 3))
+                for _ in range(rng.randint(1, 4))]
+        if kind == 'negation':
+            clauses = [['~' + term if rng.random() < 0.5 else term for term in clause]
+                    for clause in clauses]
+            if not any(term[0] == '~' for clause in clauses for term in clause):
+                clauses[0][0] = '~' + clauses[0][0]
+        queries.append(' '.join('|'.join(clause) for clause in clauses))
+    return queries
+
+def percentiles(values):
+    '''Returns the nearest rank p50, p95 and p99 and the maximum of the values'''
+    values = sorted(values)
+    if values == []:
+        return {}
+    res = {'max': values[-1]}
+    for p in (50, 95, 99):
+        res['p%(p)d' % {'p': p}] = values[max(int(math.ceil(p * len(values) / 100)) - 1, 0)]
+    return res
+
+def directory_size(directory):
+    '''Returns the total size of the files in a directory tree'''
+    return sum(os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(directory) for name in names)
+
+def run_benchmark(workdir, documents = 10000, words = 100, lemmas = 5000,
+        exponent = 1.0, queries = 200, seed = 1, compressed = False, workers = 1,
+        biwords = False, backend = 'python', partition_size = None):
+    """Builds an index of a synthetic corpus in workdir and runs the query
+    workloads on it.
+
+    Every query is answered alone, like in the interactive mode, with the
+    result cache off. The latencies are measured first, then every workload
+    is run again under tracemalloc to get the peak memory of the queries.
+    Returns the results as a dictionary."""
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        start = time.perf_counter()
+        forms = generate_corpus('data.txt', 'morfologik.txt', documents, words,
+                lemmas, exponent, seed)
+        generation_time = time.perf_counter() - start
+        data_size = os.path.getsize('data.txt')
+
+        start = time.perf_counter()
+        indexer_obj = indexer.Indexer(compressed = compressed, workers = workers,
+                biwords = biwords, partition_size = partition_size)
+        indexer_obj.create_index('data.txt', 'morfologik.txt')
+        indexing_time = time.perf_counter() - start
+        indexer_obj.close()
+
+        results = {
+            'parameters': {'documents': documents, 'words': words, 'lemmas': lemmas,
+                'exponent': exponent, 'queries': queries, 'seed': seed,
+                'compressed': compressed, 'workers': workers, 'biwords': biwords,
+                'backend': backend, 'partition_size': partition_size},
+            'generation_seconds': generation_time,
+            'indexing': {'seconds': indexing_time,
+                'documents_per_second': documents / indexing_time,
+                'megabytes_per_second': data_size / 2 ** 20 / indexing_time,
+                'data_bytes': data_size,
+                'index_bytes': directory_size('index') + os.path.getsize('TITLES')},
+            'queries': {}}
+
+        indexer_obj = indexer.Indexer()
+        indexer_obj.detect_compression()
+        indexer_obj.detect_prefix_len()
+        indexer_obj.detect_segments()
+        indexer_obj.load_titles('TITLES')
+        searcher_obj = searcher.Searcher(indexer_obj, result_cache_size = 0,
+                backend = backend)
+
+        for kind_no, kind in enumerate(KINDS):
+            workload = [searcher.Query(query) for query in generate_queries(kind, forms,
+                queries, exponent, seed + kind_no, 'data.txt')]
+            latencies = []
+            hits = []
+            for query in workload:
+                start = time.perf_counter()
+                [(total, _)] = boolsearch.run_queries(searcher_obj, indexer_obj, [query])
+                latencies.append(1000 * (time.perf_counter() - start))
+                hits.append(total)
+
+            peaks = []
+            tracemalloc.start()
+            for query in workload:
+                tracemalloc.reset_peak()
+                boolsearch.run_queries(searcher_obj, indexer_obj, [query])
+                peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+            tracemalloc.stop()
+
+            results['queries'][kind] = {'latency_ms': percentiles(latencies),
+                    'peak_memory_kb': percentiles(peaks),
+                    'mean_hits': sum(hits) / len(hits) if hits else 0}
+        results['posting_caches'] = indexer_obj.cache_stats()
+        results['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        indexer_obj.close()
+        return results
+    finally:
+        os.chdir(cwd)
+
+def parse_args():
+    '''Parses the command line arguments'''
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--documents', type = int, default = 10000,
+            help = 'number of the documents of the corpus')
+    parser.add_argument('--words', type = int, default = 100,
+            help = 'mean number of the words of a document')
+    parser.add_argument('--lemmas', type = int, default = 5000,
+            help = 'number of the lemmas of the vocabulary')
+    parser.add_argument('--exponent', type = float, default = 1.0,
+            help = 'exponent of the Zipfian distribution of the words')
+    parser.add_argument('--queries', type = int, default = 200,
+            help = 'number of the queries of every workload')
+    parser.add_argument('--seed', type = int, default = 1,
+            help = 'seed of the corpus and the workloads')
+    parser.add_argument('--compressed', action = 'store_true',
+            help = 'build a compressed index')
+    parser.add_argument('--workers', type = int, default = 1,
+            help = 'number of the inverting processes')
+    parser.add_argument('--biwords', action = 'store_true',
+            help = 'build the biword index')
+    parser.add_argument('--backend', choices = ['python', 'numpy'], default = 'python',
+            help = 'list merging engine of the searcher')
+    parser.add_argument('--partition-size', type = int,
+            help = 'cut the term dictionaries into partitions of about this many '
+            'kilobytes instead of prefix partitions')
+    parser.add_argument('--workdir',
+            help = 'directory for the corpus and the index, kept after the run '
+            '(a temporary one is removed by default)')
+    return parser.parse_args()
+
+class BenchmarkTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.data_file = os.path.join(self.workdir, 'data.txt')
+        self.morfologik_file = os.path.join(self.workdir, 'morfologik.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_corpus(self):
+        forms = generate_corpus(self.data_file, self.morfologik_file, 20, 30, 50)
+        data = open(self.data_file, encoding = 'utf-8').read()
+        self.assertEqual(forms, generate_corpus(self.data_file, self.morfologik_file,
+            20, 30, 50))
+        self.assertEqual(open(self.data_file, encoding = 'utf-8').read(), data)
+        self.assertEqual(data.count('##TITLE##'), 20)
+        self.assertEqual(forms[:len(STOP_WORDS)], STOP_WORDS)
+        known = set(line.split(' ')[0] for line in open(self.morfologik_file,
+            encoding = 'utf-8'))
+        self.assertEqual(known | set(STOP_WORDS), set(forms))
+
+    def test_queries(self):
+        forms = generate_corpus(self.data_file, self.morfologik_file, 20, 30, 50)
+        for kind in KINDS:
+            queries = generate_queries(kind, forms, 10, data_file = self.data_file)
+            self.assertEqual(len(queries), 10)
+            for query in queries:
+                self.assertEqual(searcher.Query(query).type,
+                        'phrase' if kind == 'phrase' else 'cnf')
+        self.assertTrue(all('~' in query for query in
+            generate_queries('negation', forms, 10)))
+
+    def test_percentiles(self):
+        self.assertEqual(percentiles(range(100, 0, -1)),
+                {'p50': 50, 'p95': 95, 'p99': 99, 'max': 100})
+        self.assertEqual(percentiles([]), {})
+
+    def test_run(self):
+        results = run_benchmark(self.workdir, documents = 30, words = 20, lemmas = 40,
+                queries = 5)
+        self.assertEqual(sorted(results['queries']), sorted(KINDS))
+        self.assertTrue(results['indexing']['index_bytes'] > 0)
+        self.assertTrue(results['queries']['phrase']['mean_hits'] >= 1)
+
+if __name__ == "__main__":
+    args = parse_args()
+    workdir = args.workdir or tempfile.mkdtemp()
+    try:
+        print(json.dumps(run_benchmark(workdir, args.documents, args.words, args.lemmas,
+            args.exponent, args.queries, args.seed, args.compressed, args.workers,
+            args.biwords, args.backend,
+            args.partition_size and args.partition_size * 2 ** 10), indent = 2, sort_keys = True))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
@@ -1,7 +1,8 @@
 #!/usr/bin/python3.1 -OO
 """An executable file for handling queries in an interactive or a batch mode"""
 
-import searcher, indexer, sys
+import searcher, indexer, server, stats, argparse, contextlib, io, json, multiprocessing
+import os, shutil, sys, tempfile, unittest
 
 try:
     import readline
@@ -19,6 +20,9 @@ def get_words_from_queries(indexer_obj, query_list):
             query_words = query_words_phrase
 
         for word in query.get_words():
+            # the wildcards are expanded against the index by the searcher
+            if searcher.wildcard_prefix(word) is not None:
+                continue
             query_words.setdefault(word[:indexer_obj.prefix_len], set()).add(word)
     return (query_words_cnf, query_words_phrase)
 
@@ -43,54 +47,293 @@ def normalize_words(indexer_obj, query_words_cnf, query_words_phrase):
 
     return (query_normalized_words_cnf, query_normalized_words_phrase)
 
-def search(searcher_obj, indexer_obj, queries):
-    '''Perform a search on a batch of queries'''
-    query_words_cnf, query_words_phrase = get_words_from_queries(indexer_obj, queries)
+def run_queries(searcher_obj, indexer_obj, queries, pages = None, report = None):
+    """Searches for a batch of queries.
 
-    query_normalized_words_cnf, query_normalized_words_phrase = normalize_words(indexer_obj, query_words_cnf, query_words_phrase)
+    Returns the number of the documents found and the titles of the
+    requested (offset, limit) page of them for every query, all of them if
+    the pages are not given. With the report function given, the wall time
+    of the stages, the I/O counters and the cache hits of the batch and of
+    every query are passed to it as a dictionary. The postings are loaded
+    for the whole batch before searching, so the I/O of the loading is
+    counted only for the batch (and reported apart as 'preloaded'), the
+    counters of a query have the reads done while searching it."""
+    if pages is None:
+        pages = [(0, None)] * len(queries)
+    if report is None:
+        batch_stats = stats.DISABLED
+    else:
+        batch_stats = stats.Stats(lambda: cache_stats(searcher_obj, indexer_obj))
+    query_reports = []
+    indexer_obj.stats = batch_stats
+
+    with batch_stats.stage('refresh'):
+        indexer_obj.refresh()
+    # the postings are loaded only for the queries missing from the result cache
+    pending = [query for query in queries if not searcher_obj.cached(query)]
+
+    with batch_stats.stage('morfologik'):
+        query_words_cnf, query_words_phrase = get_words_from_queries(indexer_obj, pending)
+        query_normalized_words_cnf, query_normalized_words_phrase = normalize_words(indexer_obj, query_words_cnf, query_words_phrase)
     
-    for prefix in query_normalized_words_cnf:
-        indexer_obj.load_to_index_nopos_cache(query_normalized_words_cnf[prefix], prefix)
+    with batch_stats.stage('load_postings'):
+        for prefix in query_normalized_words_cnf:
+            indexer_obj.load_to_index_nopos_cache(query_normalized_words_cnf[prefix], prefix)
 
-    for prefix in query_normalized_words_phrase:
-        indexer_obj.load_to_index_cache(query_normalized_words_phrase[prefix], prefix)
+        for prefix in query_normalized_words_phrase:
+            indexer_obj.load_to_index_cache(query_normalized_words_phrase[prefix], prefix)
 
-    indexer_obj.load_titles('TITLES')
+    if report is not None:
+        preloaded = dict(batch_stats.counters)
+
+    results = []
+    searcher_obj.begin_batch(queries)
+    try:
+        for query, (offset, limit) in zip(queries, pages):
+            if report is None:
+                query_stats = stats.DISABLED
+            else:
+                query_stats = stats.Stats(lambda: cache_stats(searcher_obj, indexer_obj))
+            indexer_obj.stats = query_stats
+            with query_stats.stage('search'):
+                docs = searcher_obj.search(query, limit)
+                total, page = searcher_obj.total_page(docs, offset, limit)
+            with query_stats.stage('titles'):
+                titles = [indexer_obj.get_title(doc) for doc in page]
+            results.append((total, titles))
+
+            if report is not None:
+                query_stats.add('total', total)
+                query_stats.add('titles', len(titles))
+                query_reports.append(dict(query_stats.report(), query = str(query)))
+                batch_stats.merge(query_stats)
+    finally:
+        searcher_obj.end_batch()
+        indexer_obj.stats = stats.DISABLED
+
+    if report is not None:
+        report(dict(batch_stats.report(), queries = query_reports,
+            preloaded = preloaded))
+    return results
+
+def cache_stats(searcher_obj, indexer_obj):
+    '''Returns the counters of the caches of the index and of the results'''
+    return dict(indexer_obj.cache_stats(), results = searcher_obj.results.stats())
+
+def print_stats(report):
+    '''Prints the stats of a batch as a JSON line on the standard error'''
+    print(json.dumps(report, sort_keys = True), file = sys.stderr)
+    sys.stderr.flush()
+
+# the searcher and the index inherited by the forked workers of a QueryPool
+POOL_STATE = None
+
+def run_chunk(chunk):
+    '''Answers a chunk of a batch in a worker, with the stats if they are wanted'''
+    searcher_obj, indexer_obj = POOL_STATE
+    queries, pages, with_stats = chunk
+    reports = []
+    results = run_queries(searcher_obj, indexer_obj, queries, pages,
+            reports.append if with_stats else None)
+    return results, reports
+
+class QueryPool:
+    """Answers the queries of a batch in parallel worker processes.
+
+    The workers are forked with the opened index, so they share its memory
+    mapped files (and the pages already read), and keep their own caches
+    between the batches. A batch is cut into consecutive chunks, one for
+    every worker, and the results are collected in the order of the
+    queries."""
+    def __init__(self, searcher_obj, indexer_obj, workers):
+        global POOL_STATE
+        POOL_STATE = (searcher_obj, indexer_obj)
+        self.workers = workers
+        self.pool = multiprocessing.get_context('fork').Pool(workers)
 
-    for query in queries:
-        result = [indexer_obj.get_title(doc) 
-                    for doc in searcher_obj.search(query)]
+    def run_queries(self, queries, pages = None, report = None):
+        '''Searches for a batch of queries like run_queries, the stats are
+        reported for every chunk'''
+        if pages is None:
+            pages = [(0, None)] * len(queries)
+        size = max(1, -(-len(queries) // self.workers))
+        chunks = [(queries[start:start + size], pages[start:start + size],
+            report is not None) for start in range(0, len(queries), size)]
+        results = []
+        for chunk_results, reports in self.pool.map(run_chunk, chunks, 1):
+            results.extend(chunk_results)
+            for chunk_report in reports:
+                report(chunk_report)
+        return results
+
+    def close(self):
+        '''Stops the workers'''
+        self.pool.terminate()
+        self.pool.join()
+
+def make_pool(searcher_obj, indexer_obj, workers):
+    '''Returns a pool of the workers, None if the queries are to be answered
+    in the main process (one worker or no fork)'''
+    if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        return QueryPool(searcher_obj, indexer_obj, workers)
+    return None
+
+def search(searcher_obj, indexer_obj, queries, offset = 0, limit = None,
+        report = None, pool = None):
+    '''Perform a search on a batch of queries, in the pool if it is given'''
+    pages = [(offset, limit)] * len(queries)
+    if pool is not None and len(queries) > 1:
+        results = pool.run_queries(queries, pages, report)
+    else:
+        results = run_queries(searcher_obj, indexer_obj, queries, pages, report)
+    for query, (total, result) in zip(queries, results):
         result_str = "\n".join(result)
-        print('QUERY:', query, 'TOTAL:', len(result))
+        print('QUERY:', query, 'TOTAL:', total)
         print(result_str)
 
-    indexer_obj.titles = []
-    indexer_obj.morfologik_cache.clear()
-    indexer_obj.index_cache.clear() 
-    indexer_obj.index_nopos_cache.clear()
+def parse_args():
+    '''Parses the command line arguments'''
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('mode', nargs = '?', choices = ['i'],
+            help = 'interactive mode, answer every query right away')
+    parser.add_argument('--cache-size', type = int, default = 256,
+            help = 'memory budget of the posting caches in MB')
+    parser.add_argument('--result-cache-size', type = int, default = 32,
+            help = 'memory budget of the query result cache in MB')
+    parser.add_argument('--backend', choices = ['python', 'numpy'], default = 'python',
+            help = 'list merging engine (numpy needs NumPy installed)')
+    parser.add_argument('--max-expansions', type = int, default = 1000,
+            help = 'number of the first index terms a wildcard (foo*) matches at most')
+    parser.add_argument('--limit', type = int,
+            help = 'print at most this many titles for a query (0 to print only the count)')
+    parser.add_argument('--offset', type = int, default = 0,
+            help = 'number of the first found documents to skip')
+    parser.add_argument('--stats', action = 'store_true',
+            help = 'print the stage timings and the I/O counters of every batch '
+            'as JSON lines on the standard error')
+    parser.add_argument('--workers', type = int, default = 1,
+            help = 'number of the processes answering the queries of a batch '
+            '(1 answers them one by one in this process)')
+    parser.add_argument('--socket',
+            help = 'serve the queries on a Unix socket instead of the standard input')
+    parser.add_argument('--port', type = int,
+            help = 'serve the queries on a TCP port instead of the standard input')
+    parser.add_argument('--host', default = 'localhost',
+            help = 'address to listen on with --port')
+    parser.add_argument('--max-pending', type = int, default = 64,
+            help = 'number of queued queries over which the server refuses new ones')
+    return parser.parse_args()
+
+class QueryPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+        with open('morfologik.txt', 'w', encoding = 'utf-8') as handle:
+            handle.write('koty kot\nkota kot\npsy pies\n')
+        with open('data.txt', 'w', encoding = 'utf-8') as handle:
+            for no, text in enumerate(['kot ma psy', 'ala ma kota', 'pies', 'koty i psy',
+                    'żółw', 'kot', 'ala ma psy', 'ma kot ala'], 1):
+                handle.write('##TITLE## Doc %(no)d\n%(text)s\n' % {'no': no, 'text': text})
+        indexer.Indexer().create_index('data.txt', 'morfologik.txt')
+        self.indexer_obj = indexer.Indexer()
+        self.indexer_obj.detect_compression()
+        self.indexer_obj.detect_prefix_len()
+        self.indexer_obj.detect_segments()
+        self.indexer_obj.load_titles('TITLES')
+        self.searcher_obj = searcher.Searcher(self.indexer_obj)
+
+    def tearDown(self):
+        self.indexer_obj.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    @unittest.skipIf('fork' not in multiprocessing.get_all_start_methods(),
+            "The pool needs fork")
+    def test_pool(self):
+        queries = [searcher.Query(query) for query in ['kot', 'pies|ala', '~kot',
+            '"ala ma"', 'kot ma', 'żółw', 'ma|pies']]
+        pages = [(0, None), (1, 2), (0, 0), (0, None), (0, 1), (0, None), (2, None)]
+        pool = make_pool(self.searcher_obj, self.indexer_obj, 2)
+        reports = []
+        try:
+            results = pool.run_queries(queries, pages, reports.append)
+        finally:
+            pool.close()
+        self.assertEqual(results, run_queries(self.searcher_obj, self.indexer_obj,
+            queries, pages))
+        self.assertEqual(results[0], (5, ['Doc 1', 'Doc 2', 'Doc 4', 'Doc 6', 'Doc 8']))
+        self.assertEqual(len(reports), 2)
+        self.assertEqual([query['query'] for report in reports
+            for query in report['queries']], [str(query) for query in queries])
+
+    def test_preloaded(self):
+        reports = []
+        run_queries(self.searcher_obj, self.indexer_obj,
+                [searcher.Query('kot'), searcher.Query('pies')], report = reports.append)
+        self.assertTrue(reports[0]['preloaded']['bytes_read'] > 0)
+        self.assertEqual(reports[0]['counters']['bytes_read'],
+                reports[0]['preloaded']['bytes_read'])
+        self.assertEqual([query['counters'].get('bytes_read', 0)
+            for query in reports[0]['queries']], [0, 0])
+
+    def test_serial(self):
+        self.assertEqual(make_pool(self.searcher_obj, self.indexer_obj, 1), None)
+
+        class PoolMock:
+            def run_queries(self, queries, pages = None, report = None):
+                raise Exception("A single query is answered in the pool")
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            search(self.searcher_obj, self.indexer_obj, [searcher.Query('psy')],
+                    pool = PoolMock())
+        self.assertEqual(output.getvalue(),
+                'QUERY: psy TOTAL: 4\nDoc 1\nDoc 3\nDoc 4\nDoc 7\n')
 
 if __name__ == "__main__":
-    indexer_obj = indexer.Indexer()
+    args = parse_args()
+    indexer_obj = indexer.Indexer(cache_size = args.cache_size * 2 ** 20)
     indexer_obj.detect_compression()
     indexer_obj.detect_prefix_len()
-    searcher_obj = searcher.Searcher(indexer_obj)
+    indexer_obj.detect_segments()
+    indexer_obj.load_titles('TITLES')
+    searcher_obj = searcher.Searcher(indexer_obj,
+            result_cache_size = args.result_cache_size * 2 ** 20, backend = args.backend,
+            max_expansions = args.max_expansions)
+    report = print_stats if args.stats else None
+    pool = make_pool(searcher_obj, indexer_obj, args.workers)
 
-    if len(sys.argv) > 1 and sys.argv[1] == 'i':
-        n = 1
+    if args.socket is not None or args.port is not None:
+        if pool is not None:
+            run_batch = lambda queries, pages: pool.run_queries(queries, pages, report)
+        else:
+            run_batch = lambda queries, pages: run_queries(searcher_obj, indexer_obj,
+                    queries, pages, report)
+        # the forked workers answer the batches of many server threads at once
+        server.serve(run_batch, args.socket, args.host, args.port,
+                args.max_pending, (args.offset, args.limit),
+                args.workers if pool is not None else 1)
     else:
-        n = 50
+        if args.mode == 'i':
+            n = 1
+        else:
+            n = 50
 
-    try:
-        eof = False
-        while not eof:
-            queries = []
-            for _ in range(n):
-                try:
-                    queries.append(searcher.Query(input()))
-                except EOFError:
-                    eof = True
-                    break
-            if queries != []:
-                search(searcher_obj, indexer_obj, queries)
-    except KeyboardInterrupt:
-        pass
+        try:
+            eof = False
+            while not eof:
+                queries = []
+                for _ in range(n):
+                    try:
+                        queries.append(searcher.Query(input()))
+                    except EOFError:
+                        eof = True
+                        break
+                if queries != []:
+                    search(searcher_obj, indexer_obj, queries, args.offset, args.limit,
+                            report, pool)
+        except KeyboardInterrupt:
+            pass
+
+    if pool is not None:
+        pool.close()
@@ -0,0 +1,136 @@
+#!/usr/bin/python3.1 -OO
+'''File for the bounded caches used by the Indexer and tests for them'''
+import unittest
+import collections
+
+class LRUCache:
+    """A dictionary evicting the least recently used entries over a budget.
+
+    The cost of an entry is computed by the sizeof function (1 by default, so
+    the budget is the number of entries). Entries costing more than the whole
+    budget are not stored at all."""
+    def __init__(self, budget, sizeof = lambda value: 1):
+        self.budget = budget
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        cost = self.sizeof(value)
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        if cost > self.budget:
+            return
+        self.entries[key] = (value, cost)
+        self.size += cost
+        while self.size > self.budget:
+            _, (_, evicted_cost) = self.entries.popitem(last = False)
+            self.size -= evicted_cost
+
+    def get(self, key, default = None):
+        '''Gets an entry, counting the hits and the misses'''
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def clear(self):
+        '''Removes all the entries, keeping the counters'''
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        '''Returns the counters and the occupancy of the cache'''
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries), 'size': self.size,
+                'budget': self.budget}
+
+class Memo(dict):
+    """A bounded memo of a function, for lookups too frequent for an LRUCache.
+
+    A missing key is computed with the function, and when the memo holds the
+    budget of entries it is emptied first, the frequent keys come back right
+    away. The hits are not counted one by one: they are the lookups minus the
+    misses, and the callers add their lookups, in bulk where they can."""
+    def __init__(self, function, budget):
+        dict.__init__(self)
+        self.function = function
+        self.budget = budget
+        self.lookups = 0
+        self.misses = 0
+
+    def __missing__(self, key):
+        self.misses += 1
+        if len(self) >= self.budget:
+            self.clear()
+        value = self[key] = self.function(key)
+        return value
+
+    def stats(self):
+        '''Returns the counters and the occupancy of the memo, like LRUCache.stats'''
+        hits = self.lookups - self.misses
+        return {'hits': hits, 'misses': self.misses,
+                'hit_rate': hits / self.lookups if self.lookups else 0.0,
+                'entries': len(self), 'size': len(self), 'budget': self.budget}
+
+class LRUCacheTest(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(3)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['c'] = 3
+        self.assertEqual(cache.get('a'), 1)
+        cache['d'] = 4
+        self.assertFalse('b' in cache)
+        self.assertEqual(sorted(cache.entries), ['a', 'c', 'd'])
+
+    def test_sizeof(self):
+        cache = LRUCache(10, len)
+        cache['a'] = 'xxxxxx'
+        cache['b'] = 'yyyyyy'
+        self.assertFalse('a' in cache)
+        cache['c'] = 'z' * 11
+        self.assertFalse('c' in cache)
+        self.assertEqual(cache.size, 6)
+
+    def test_counters(self):
+        cache = LRUCache(2)
+        cache['a'] = None
+        self.assertEqual(cache.get('a', 0), None)
+        self.assertEqual(cache.get('b', 0), 0)
+        self.assertRaises(KeyError, lambda: cache['b'])
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+class MemoTest(unittest.TestCase):
+    def test_memo(self):
+        calls = []
+        memo = Memo(lambda key: calls.append(key) or key.upper(), 2)
+        memo.lookups += 4
+        self.assertEqual([memo['a'], memo['b'], memo['a'], memo['c']], ['A', 'B', 'A', 'C'])
+        self.assertEqual(calls, ['a', 'b', 'c'])
+        self.assertEqual(len(memo), 1)
+        self.assertEqual(memo.stats()['hits'], 1)
+        self.assertEqual(memo.stats()['misses'], 3)
+
+if __name__ == "__main__":
+    unittest.main()
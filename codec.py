@@ -0,0 +1,383 @@
+#!/usr/bin/python3.1 -OO
+'''File for the block integer codec of the posting lists and tests for it'''
+import unittest
+import array
+import bisect
+import itertools
+import struct
+import sys
+
+BLOCK_SIZE = 64
+HEADER = struct.Struct('<IIBB')
+BITMAP_HEADER = struct.Struct('<II')
+
+UINT32 = 'I' if array.array('I').itemsize == 4 else 'L'
+WIDTHS = {8: 'B', 16: 'H', 32: UINT32}
+PACKED = (1, 2, 4)
+SHIFT = dict((bits, [bytes((value << (k * bits)) & 0xFF for value in range(256))
+        for k in range(8 // bits)]) for bits in PACKED)
+BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+EXTRACT = dict((bits, [bytes((value >> (k * bits)) & ((1 << bits) - 1)
+        for value in range(256)) for k in range(8 // bits)]) for bits in PACKED)
+
+def width(value):
+    '''Returns the number of bits needed to store a value'''
+    for bits in PACKED + (8, 16):
+        if value < 1 << bits:
+            return bits
+    return 32
+
+def to_little_endian(arr):
+    '''Converts an array to the on-disk byte order'''
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+def pack(values, bits):
+    '''Packs integers into bytes using the given number of bits for each'''
+    if bits >= 8:
+        return to_little_endian(array.array(WIDTHS[bits], values)).tobytes()
+
+    per_byte = 8 // bits
+    length = (len(values) + per_byte - 1) // per_byte
+    packed = 0
+    for k in range(per_byte):
+        part = bytes(values[k::per_byte]).translate(SHIFT[bits][k])
+        packed |= int.from_bytes(part, 'little')
+    return packed.to_bytes(length, 'little')
+
+def unpack(data, bits, length):
+    '''Unpacks a number of integers packed with the given number of bits'''
+    if bits >= 8:
+        values = array.array(WIDTHS[bits])
+        values.frombytes(data[:length * bits // 8])
+        return to_little_endian(values)
+
+    per_byte = 8 // bits
+    data = bytes(data[:(length + per_byte - 1) // per_byte])
+    values = bytearray(len(data) * per_byte)
+    for k in range(per_byte):
+        values[k::per_byte] = data.translate(EXTRACT[bits][k])
+    return array.array('B', values[:length])
+
+def packed_size(bits, length):
+    '''Returns the number of bytes taken by packed integers'''
+    return (length * bits + 7) // 8
+
+def byte_width(value):
+    '''Returns the number of bits of the smallest whole bytes storing a value'''
+    return max(8, width(value))
+
+def choose_bits(values):
+    '''Chooses the packing width minimizing the size, with exceptions'''
+    if values == []:
+        return 1, 8
+    ordered = sorted(values)
+    best = None
+    for bits in PACKED + (8, 16, 32):
+        exceptions = len(ordered) - bisect.bisect_left(ordered, 1 << bits)
+        high_bits = byte_width(ordered[-1] >> bits)
+        size = (packed_size(bits, len(values)) +
+                exceptions * (1 + high_bits // 8))
+        if best is None or size < best[0]:
+            best = (size, bits, high_bits)
+    return best[1:]
+
+def block_count(total):
+    '''Returns the number of blocks for a number of integers'''
+    return (total + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+def encode(values, gaps = True):
+    """Encodes a list of integers with patched frame of reference.
+
+    All the values are packed with the number of bits minimizing the size,
+    the ones that do not fit are stored as exceptions: their indices in the
+    block and the high bits, patched in while decoding. The blob starts with
+    a header (count, exceptions, bits, high bits) and a table with the last
+    value and the first exception of every block of BLOCK_SIZE values, so that
+    a single block can be decoded without touching the rest of the blob. With
+    gaps set the values have to be sorted and the differences are stored."""
+    if gaps:
+        stored = [value - prev for value, prev in
+                zip(values, itertools.chain([0], values))]
+    else:
+        stored = list(values)
+    bits, high_bits = choose_bits(stored)
+    mask = (1 << bits) - 1
+    exceptions = [i for i, value in enumerate(stored) if value > mask]
+
+    table = array.array(UINT32)
+    for start in range(0, len(values), BLOCK_SIZE):
+        table.append(values[min(start + BLOCK_SIZE, len(values)) - 1])
+        table.append(bisect.bisect_left(exceptions, start))
+
+    header = HEADER.pack(len(values), len(exceptions), bits, high_bits)
+    return (header + to_little_endian(table).tobytes() +
+            pack([value & mask for value in stored], bits) +
+            bytes(i % BLOCK_SIZE for i in exceptions) +
+            pack([stored[i] >> bits for i in exceptions], high_bits))
+
+def blob_size(buf, offset = 0):
+    '''Returns the size in bytes of the blob starting at the offset'''
+    total, exceptions, bits, high_bits = HEADER.unpack_from(buf, offset)
+    return (HEADER.size + 8 * block_count(total) + packed_size(bits, total) +
+            exceptions * (1 + high_bits // 8))
+
+def count(buf, offset = 0):
+    '''Returns the number of integers in the blob'''
+    return HEADER.unpack_from(buf, offset)[0]
+
+def table_size(buf, offset = 0):
+    '''Returns the size in bytes of the header and the block table of the blob'''
+    return HEADER.size + 8 * block_count(count(buf, offset))
+
+def block_size(buf, block_no, starts, offset = 0):
+    '''Returns the number of bytes of the blob read to decode a single block'''
+    total, exceptions, bits, high_bits = HEADER.unpack_from(buf, offset)
+    if block_no + 1 < len(starts):
+        exc_end = starts[block_no + 1]
+    else:
+        exc_end = exceptions
+    return (packed_size(bits, min(BLOCK_SIZE, total - block_no * BLOCK_SIZE)) +
+            (exc_end - starts[block_no]) * (1 + high_bits // 8))
+
+def decoded_size(buf, offset = 0, blobs = 1):
+    '''Returns the size in bytes of the integers decoded from consecutive blobs'''
+    size = 0
+    for _ in range(blobs):
+        size += 4 * count(buf, offset)
+        offset += blob_size(buf, offset)
+    return size
+
+def block_table(buf, offset = 0):
+    '''Returns the last values and first exceptions of the blocks of the blob'''
+    total = count(buf, offset)
+    start = offset + HEADER.size
+    table = array.array(UINT32)
+    table.frombytes(buf[start:start + 8 * block_count(total)])
+    to_little_endian(table)
+    return table[0::2], table[1::2]
+
+def decode_block(buf, block_no, lasts, starts, gaps = True, offset = 0):
+    '''Decodes a single block of the blob into a list'''
+    total, exceptions, bits, high_bits = HEADER.unpack_from(buf, offset)
+    data = offset + HEADER.size + 8 * block_count(total)
+    first = block_no * BLOCK_SIZE
+    length = min(BLOCK_SIZE, total - first)
+    start = data + first * bits // 8
+    values = unpack(buf[start:start + packed_size(bits, length)],
+            bits, length).tolist()
+
+    exc_start = starts[block_no]
+    if block_no + 1 < len(starts):
+        exc_end = starts[block_no + 1]
+    else:
+        exc_end = exceptions
+    if exc_end > exc_start:
+        indices = data + packed_size(bits, total)
+        highs = indices + exceptions
+        high_bytes = high_bits // 8
+        patches = zip(buf[indices + exc_start:indices + exc_end],
+                unpack(buf[highs + exc_start * high_bytes:
+                    highs + exc_end * high_bytes],
+                    high_bits, exc_end - exc_start))
+        for i, high in patches:
+            values[i] += high << bits
+
+    if gaps:
+        base = lasts[block_no - 1] if block_no > 0 else 0
+        return list(itertools.accumulate(itertools.chain([base], values)))[1:]
+    else:
+        return values
+
+def decode(buf, gaps = True, offset = 0):
+    '''Decodes a whole blob into an unsigned integer array'''
+    total, exceptions, bits, high_bits = HEADER.unpack_from(buf, offset)
+    data = offset + HEADER.size + 8 * block_count(total)
+    size = packed_size(bits, total)
+    values = unpack(buf[data:data + size], bits, total)
+    if bits < 32:
+        values = array.array(UINT32, values)
+
+    if exceptions:
+        _, starts = block_table(buf, offset)
+        indices = data + size
+        highs = indices + exceptions
+        highs = unpack(buf[highs:highs + exceptions * high_bits // 8],
+                high_bits, exceptions)
+        block_no = 0
+        for exception, i in enumerate(buf[indices:indices + exceptions]):
+            while block_no + 1 < len(starts) and starts[block_no + 1] <= exception:
+                block_no += 1
+            values[block_no * BLOCK_SIZE + i] += highs[exception] << bits
+
+    if gaps:
+        values = array.array(UINT32, itertools.accumulate(values))
+    return values
+
+def encode_bitmap(docs):
+    """Encodes sorted documents as a bitmap, bit d set for the document d.
+
+    The bitmap starts at the byte of the first document, its number is kept
+    in the header with the length, so the documents of a segment far from
+    document 0 are not padded with empty bytes."""
+    base = docs[0] >> 3 if docs else 0
+    data = bytearray((docs[-1] >> 3) + 1 - base if docs else 0)
+    for doc in docs:
+        data[(doc >> 3) - base] |= 1 << (doc & 7)
+    return BITMAP_HEADER.pack(base, len(data)) + bytes(data)
+
+def bitmap_size(buf, offset = 0):
+    '''Returns the size in bytes of the bitmap starting at the offset'''
+    return BITMAP_HEADER.size + BITMAP_HEADER.unpack_from(buf, offset)[1]
+
+def bitmap_base(buf, offset = 0):
+    '''Returns the number of the first byte of the documents in the bitmap'''
+    return BITMAP_HEADER.unpack_from(buf, offset)[0]
+
+def bitmap_data(buf, offset = 0):
+    '''Returns the bytes of the bitmap starting at the offset'''
+    return buf[offset + BITMAP_HEADER.size:offset + bitmap_size(buf, offset)]
+
+def decode_bitmap(data, base = 0):
+    '''Decodes the bytes of a bitmap starting at the byte base into an
+    unsigned integer array'''
+    return array.array(UINT32, [((byte_no + base) << 3) + bit
+        for byte_no, value in enumerate(data) if value for bit in BITS[value]])
+
+def encode_positions(posting):
+    '''Encodes the counts and the positions of a positional posting'''
+    counts = [len(positions) for _, positions in posting]
+    gaps = [pos - prev for _, positions in posting
+            for pos, prev in zip(positions, itertools.chain([0], positions))]
+    return encode(counts, gaps = False) + encode(gaps, gaps = False)
+
+def encode_positional(posting):
+    '''Encodes a positional posting into documents, counts and positions'''
+    return encode([doc for doc, _ in posting]) + encode_positions(posting)
+
+def decode_positional(buf, offset = 0):
+    '''Generator for the (document, positions) pairs of a positional blob'''
+    docs = decode(buf, offset = offset)
+    return decode_positions(buf, docs, offset + blob_size(buf, offset))
+
+def decode_positions(buf, docs, offset = 0):
+    '''Generator for the (document, positions) pairs of the given documents'''
+    counts = decode(buf, gaps = False, offset = offset)
+    offset += blob_size(buf, offset)
+    gaps = decode(buf, gaps = False, offset = offset)
+    start = 0
+    for doc, cnt in zip(docs, counts):
+        yield doc, list(itertools.accumulate(gaps[start:start + cnt]))
+        start += cnt
+
+def encode_raw(values):
+    '''Encodes integers as a plain little endian array'''
+    return to_little_endian(array.array(UINT32, values)).tobytes()
+
+def decode_raw(buf, length, offset = 0):
+    '''Returns a sequence of plain integers, without copying when possible'''
+    data = buf[offset:offset + 4 * length]
+    if isinstance(data, memoryview) and sys.byteorder == 'little':
+        return data.cast(UINT32)
+    values = array.array(UINT32)
+    values.frombytes(data)
+    return to_little_endian(values)
+
+def encode_raw_positions(posting):
+    '''Encodes the plain counts and positions of a positional posting'''
+    return (encode_raw(len(positions) for _, positions in posting) +
+            encode_raw(pos for _, positions in posting for pos in positions))
+
+def encode_raw_positional(posting):
+    '''Encodes a positional posting into plain documents, counts and positions'''
+    return encode_raw(doc for doc, _ in posting) + encode_raw_positions(posting)
+
+def decode_raw_positional(buf, length, offset = 0):
+    '''Generator for the (document, positions) pairs of a plain positional posting'''
+    docs = decode_raw(buf, length, offset)
+    return decode_raw_positions(buf, docs, offset + 4 * length)
+
+def decode_raw_positions(buf, docs, offset = 0):
+    '''Generator for the (document, positions) pairs of the given documents'''
+    counts = decode_raw(buf, len(docs), offset)
+    start = offset + 4 * len(docs)
+    for doc, cnt in zip(docs, counts):
+        yield doc, decode_raw(buf, cnt, start)
+        start += 4 * cnt
+
+class CodecTest(unittest.TestCase):
+    def test_sizes(self):
+        values = list(range(0, 3000, 3)) + [10 ** 9]
+        blob = b'xx' + encode(values) + encode([1, 2])
+        _, starts = block_table(blob, 2)
+        self.assertEqual(table_size(blob, 2) + sum(block_size(blob, block_no, starts, 2)
+            for block_no in range(len(starts))), blob_size(blob, 2))
+        self.assertEqual(decoded_size(blob, 2, 2), 4 * (len(values) + 2))
+
+    def test_bitmap(self):
+        docs = [1, 2, 3, 8, 15, 16, 1000]
+        blob = b'xx' + encode_bitmap(docs)
+        self.assertEqual(bitmap_size(blob, 2), len(blob) - 2)
+        self.assertEqual(list(decode_bitmap(bitmap_data(blob, 2))), docs)
+        self.assertEqual(list(decode_bitmap(bitmap_data(encode_bitmap([])))), [])
+        blob = encode_bitmap([100001, 100002, 100017])
+        self.assertEqual(bitmap_size(blob), BITMAP_HEADER.size + 3)
+        self.assertEqual(bitmap_base(blob), 12500)
+        self.assertEqual(list(decode_bitmap(bitmap_data(blob), bitmap_base(blob))),
+                [100001, 100002, 100017])
+        posting = [(1, [3, 7]), (4, [1]), (300, [2, 90000, 90001])]
+        blob = encode_bitmap([1, 4, 300]) + encode_positions(posting)
+        self.assertEqual(list(decode_positions(blob, [1, 4, 300], bitmap_size(blob))), posting)
+
+    def test_pack(self):
+        for bits in (1, 2, 4, 8, 16, 32):
+            values = [(i * 7919) % (1 << bits) for i in range(61)]
+            data = pack(values, bits)
+            self.assertEqual(len(data), packed_size(bits, len(values)))
+            self.assertEqual(list(unpack(data, bits, len(values))), values)
+
+    def test_exceptions(self):
+        values = [1, 2, 3, 300, 2, 1, 70000, 0] * 8
+        blob = encode(values, gaps = False)
+        self.assertEqual(list(decode(blob, gaps = False)), values)
+        self.assertTrue(blob_size(blob) < 4 * len(values))
+
+    def test_roundtrip(self):
+        values = list(range(1, 10000, 3)) + [70000, 5000000]
+        blob = encode(values)
+        self.assertEqual(count(blob), len(values))
+        self.assertEqual(blob_size(blob), len(blob))
+        self.assertEqual(list(decode(blob)), values)
+        self.assertEqual(list(decode(encode(values, gaps = False), gaps = False)), values)
+
+    def test_blocks(self):
+        values = list(range(5, 1000, 5))
+        values[100] += 2
+        values[130:] = [value + 100000 for value in values[130:]]
+        blob = encode(values)
+        lasts, starts = block_table(blob)
+        self.assertEqual(len(lasts), 4)
+        self.assertEqual(lasts[-1], 100995)
+        self.assertEqual(decode_block(blob, 1, lasts, starts), values[BLOCK_SIZE:2 * BLOCK_SIZE])
+        self.assertEqual(decode_block(blob, 2, lasts, starts), values[2 * BLOCK_SIZE:3 * BLOCK_SIZE])
+        self.assertEqual(decode_block(blob, 3, lasts, starts), values[3 * BLOCK_SIZE:])
+
+    def test_empty(self):
+        self.assertEqual(list(decode(encode([]))), [])
+        self.assertEqual(list(decode_positional(encode_positional([]))), [])
+
+    def test_positional(self):
+        posting = [(1, [3, 7]), (4, [1]), (300, [2, 90000, 90001])]
+        blob = encode_positional(posting)
+        self.assertEqual(list(decode_positional(blob)), [(d, p) for d, p in posting])
+        self.assertEqual(list(decode_positional(b'xx' + blob, offset = 2)), posting)
+
+    def test_raw(self):
+        posting = [(1, [3, 7]), (4, [1]), (300, [2, 90000, 90001])]
+        blob = memoryview(b'xx' + encode_raw_positional(posting))
+        self.assertEqual(list(decode_raw(blob, 3, 2)), [1, 4, 300])
+        self.assertEqual([(d, list(p)) for d, p in decode_raw_positional(blob, 3, 2)], posting)
+
+if __name__ == "__main__":
+    unittest.main()
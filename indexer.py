@@ -2,33 +2,124 @@
 """File containing the Indexer class and some tests for it"""
 import os
 import re
-import marshal
+import array
+import bisect
+import fcntl
+import contextlib
+import heapq
+import itertools
+import multiprocessing
 import sys
-import gzip
-import copy
+import shutil
+import struct
+import tempfile
+import unittest
+import cache
+import codec
+import posting
+import runs
+import stats
+import termdict
+import titles
+
+ENTRY_HEADER = struct.Struct('<I')
+# flag of the document frequency of entries keeping the documents as a bitmap
+BITMAP_ENTRY = 1 << 31
+# terms in at least 1/BITMAP_DENSITY of the documents they span get a bitmap
+BITMAP_DENSITY = 16
+# estimated memory taken by a new term during the inversion
+TERM_COST = 200
+# the segment built by create_index, stored directly in the index directory
+BASE_SEGMENT = '.'
+# the file names of the partitions cut by size, numbered in the term order
+PARTITION_NAME = 'P%(no)05d'
+# the characters the indexed terms are made of
+ILLEGAL_CHAR = re.compile(r'[^0-9a-zęóąśłżźćń]')
 
 def immediate_print(string):
     """A function to print and flush the stdout immediately"""
     print(string)
     sys.stdout.flush()
 
+def morfologik_size(bases):
+    """Estimates the memory taken by a cached list of bases"""
+    return 64 + sum(50 + len(base) for base in bases)
+
+def posting_size(docs):
+    """Estimates the memory taken by a cached posting"""
+    if isinstance(docs, posting.Bitmap):
+        return 64 + len(docs.data)
+    return 64 + 4 * len(docs)
+
+def entry_header(entry):
+    """Returns the document frequency of an index entry and whether its
+    documents are kept as a bitmap"""
+    value = ENTRY_HEADER.unpack_from(entry)[0]
+    return value & ~BITMAP_ENTRY, value & BITMAP_ENTRY != 0
+
+def positional_size(positional):
+    """Estimates the memory taken by a cached positional posting"""
+    return 64 + sum(100 + 4 * len(positions) for _, positions in positional)
+
+def read_lines(filename, start, end):
+    """Generator for the lines of a file between two byte offsets"""
+    with open(filename, 'rb') as handle:
+        handle.seek(start)
+        offset = start
+        for line in handle:
+            if offset >= end:
+                break
+            offset += len(line)
+            yield line.decode('utf-8')
+
+def invert_shard(shard):
+    """Inverts a shard of the documents in a worker process"""
+    return shard_indexer.invert_range(*shard)
+
+# the Indexer inherited by the forked workers of a parallel build
+shard_indexer = None
+
 class Indexer:
     """A class for generating index files and getting posting lists"""
-    morfologik = {}
-    morfologik_cache = {}
-    index_cache = {}
-    index_nopos_cache = {}
-    titles = []
-    document_count = 0
 
     def __init__(self, index_dir = "index", compressed = False, stemmed = False,
-            debug = False, prefix_len = 3):
+            debug = False, prefix_len = 3, cache_size = 256 * 2 ** 20,
+            open_partitions = 256, memory_budget = 512 * 2 ** 20, workers = 1,
+            biwords = False, partition_size = None, normalized_forms = 2 ** 18):
 
         self.stemmed = stemmed
         self.compressed = compressed
         self.index_dir = index_dir
         self.debug = debug
         self.prefix_len = prefix_len
+        self.memory_budget = memory_budget
+        self.workers = workers
+        self.biwords = biwords
+        # partitions of about this many bytes instead of prefix partitions
+        self.partition_size = partition_size
+        self.term_counts = {}
+        self.frequent = None
+        self.morfologik = None
+        self.titles = []
+        self.titles_file = None
+        self.title_stores = []
+        self.title_starts = []
+        self.document_count = 0
+        self.segments = [(BASE_SEGMENT, 0)]
+        self.deleted = []
+        self.deleted_set = set()
+        self.segments_version = None
+        # the I/O counters of the current query, off unless a caller sets them
+        self.stats = stats.DISABLED
+
+        # the decoded postings take most of the memory budget
+        self.morfologik_cache = cache.LRUCache(cache_size // 8, morfologik_size)
+        self.index_nopos_cache = cache.LRUCache(cache_size * 3 // 8, posting_size)
+        self.index_cache = cache.LRUCache(cache_size // 2, positional_size)
+        self.partitions = cache.LRUCache(open_partitions)
+        self.partition_tables = {}
+        # the indexable bases of the surface forms met while indexing or searching
+        self.normalized = cache.Memo(self.normalize_form, normalized_forms)
         if self.stemmed:
             self.stemsufix = re.compile(r'''(.*)((logia|janin|owanie)|\
                                                 (czyk|rzeć|arty|enie|ślać|acja|ować)|\
@@ -45,13 +136,97 @@ class Indexer:
             self.compressed = False
 
     def detect_prefix_len(self):
-        '''Set the prefix length according to the index'''
+        '''Set the prefix length and the partition size according to the index'''
         prefix_len_file = os.path.join(self.index_dir, 'PREFIX_LENGTH')
         if os.path.exists(prefix_len_file):
             prefix_len_handle = open(prefix_len_file, 'r')
             self.prefix_len = int(next(prefix_len_handle))
         else:
             raise Exception("No prefix length information in the index")
+        partition_size_file = os.path.join(self.index_dir, 'PARTITION_SIZE')
+        if os.path.exists(partition_size_file):
+            self.partition_size = int(open(partition_size_file, 'r').read())
+        else:
+            self.partition_size = None
+
+    def detect_segments(self):
+        """Reads the segment list and the deleted documents of the index.
+
+        The segments are (name, document count) pairs in the document order,
+        the base segment is the one built by create_index. Returns whether
+        anything changed since the last call."""
+        segments_file = os.path.join(self.index_dir, 'SEGMENTS')
+        deleted_file = os.path.join(self.index_dir, 'DELETED')
+        version = tuple((stat.st_ino, stat.st_mtime_ns, stat.st_size)
+                if stat else None for stat in (Indexer.stat(segments_file),
+                    Indexer.stat(deleted_file)))
+        if version == self.segments_version:
+            return False
+        self.segments_version = version
+
+        if version[0] is None:
+            self.segments = [(BASE_SEGMENT, 0)]
+        else:
+            self.segments = []
+            for line in open(segments_file, 'r'):
+                name, doc_count = line.split()
+                self.segments.append((name, int(doc_count)))
+
+        deleted = array.array(codec.UINT32)
+        if version[1] is not None:
+            with open(deleted_file, 'rb') as handle:
+                deleted.frombytes(handle.read())
+        self.deleted_set = set(codec.to_little_endian(deleted))
+        self.deleted = sorted(self.deleted_set)
+        return True
+
+    @staticmethod
+    def stat(filename):
+        """Stats a file, None if it does not exist"""
+        try:
+            return os.stat(filename)
+        except OSError:
+            return None
+
+    def refresh(self):
+        """Picks up new segments and deletions, dropping the cached postings"""
+        if self.detect_segments():
+            self.close()
+            if self.titles_file is not None:
+                self.load_titles(self.titles_file)
+
+    @contextlib.contextmanager
+    def lock(self, name = 'LOCK', blocking = True):
+        """Holds an exclusive lock on a file of the index, yields whether it
+        was taken (it always is when blocking)"""
+        with open(os.path.join(self.index_dir, name), 'w') as handle:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def write_segments(self, segments):
+        """Atomically replaces the segment list of the index"""
+        segments_file = os.path.join(self.index_dir, 'SEGMENTS')
+        with open(segments_file + '.tmp', 'w') as handle:
+            for name, doc_count in segments:
+                handle.write('%(name)s %(count)d\n' % {'name': name, 'count': doc_count})
+        os.replace(segments_file + '.tmp', segments_file)
+
+    def new_segment(self):
+        """Creates the directory of a new segment, returns its name"""
+        segment_dir = os.path.join(self.index_dir, 'segments')
+        if not os.path.exists(segment_dir):
+            os.mkdir(segment_dir)
+        numbers = [int(name) for name in os.listdir(segment_dir) if name.isdigit()]
+        name = os.path.join('segments', '%(no)05d' % {'no': max(numbers + [0]) + 1})
+        os.mkdir(os.path.join(self.index_dir, name))
+        return name
 
 
     def create_index(self, data_file, morfologik_file):
@@ -69,11 +244,15 @@ class Indexer:
         prefix_len_file = os.path.join(self.index_dir, 'PREFIX_LENGTH')
         prefix_len_handle = open(prefix_len_file, 'w')
         prefix_len_handle.write(str(self.prefix_len))
+        prefix_len_handle.close()
+
+        partition_size_file = os.path.join(self.index_dir, 'PARTITION_SIZE')
+        if self.partition_size is not None:
+            with open(partition_size_file, 'w') as handle:
+                handle.write(str(self.partition_size))
+        elif os.path.exists(partition_size_file):
+            os.remove(partition_size_file)
 
-        if self.debug:
-            immediate_print("initializing morfologik")
-        self.initialize_morfologik(morfologik_file)
-        
         if self.debug:
             immediate_print("sorting morfologik")
         Indexer.sort_file(morfologik_file, 'MORFOLOGIK.sorted')
@@ -81,54 +260,209 @@ class Indexer:
         if self.debug:
             immediate_print("generating morfologik index")
         self.generate_dicts("MORFOLOGIK.sorted",
-                os.path.join(self.index_dir, "morfologik"), True)
+                os.path.join(self.index_dir, "MORFOLOGIK"))
 
         if not self.debug:
             os.remove('MORFOLOGIK.sorted')
 
+        run_dir = os.path.join(self.index_dir, 'runs')
+        if not os.path.exists(run_dir):
+            os.mkdir(run_dir)
+
         if self.debug:
-            immediate_print("gathering document data")
-        self.generate_index_file(data_file, 'WORDS')
+            immediate_print("inverting document data")
+        self.term_counts = {}
+        run_files = self.invert_documents(data_file, run_dir)
+
+        frequent_file = os.path.join(self.index_dir, 'FREQUENT')
+        if self.biwords:
+            self.frequent = self.choose_frequent(len(self.titles))
+            with open(frequent_file, 'w', encoding = 'utf-8') as handle:
+                handle.write(''.join(term + '\n' for term in sorted(self.frequent)))
+            self.term_counts = {}
+            if self.debug:
+                immediate_print("inverting biwords of %(count)d frequent terms" %
+                        {'count': len(self.frequent)})
+            titles = self.titles
+            self.titles = []
+            if self.frequent != set():
+                run_files += self.invert_documents(data_file, run_dir, self.frequent)
+            self.titles = titles
+        elif os.path.exists(frequent_file):
+            os.remove(frequent_file)
 
         if self.debug:
             immediate_print("dumping document titles")
         self.dump_titles('TITLES')
 
         if self.debug:
-            immediate_print("sorting document data")
-        Indexer.sort_file('WORDS', 'WORDS.sorted')
+            immediate_print("merging %(count)d runs" % {'count': len(run_files)})
+        self.merge_runs(run_files, self.index_dir)
 
         if not self.debug:
-            os.remove('WORDS')
+            for run_file in run_files:
+                os.remove(run_file)
+            os.rmdir(run_dir)
 
-        if self.debug:
-            immediate_print("generating index")
-        self.generate_dicts('WORDS.sorted', self.index_dir)
+        shutil.rmtree(os.path.join(self.index_dir, 'segments'), ignore_errors = True)
+        if os.path.exists(os.path.join(self.index_dir, 'DELETED')):
+            os.remove(os.path.join(self.index_dir, 'DELETED'))
+        self.write_segments([(BASE_SEGMENT, len(self.titles))])
 
-        if not self.debug:
-            os.remove('WORDS.sorted')
+    def add_documents(self, data_file):
+        """Indexes new documents as a new, small segment of the index.
+
+        The documents get the numbers following the ones already indexed,
+        only the new segment is written: the prefix partitions of the other
+        segments, the morfologik index and the TITLES file stay untouched."""
+        if not os.path.exists(os.path.join(self.index_dir, 'SEGMENTS')):
+            raise Exception("No segment information in the index, rebuild it")
+
+        with self.lock():
+            self.detect_segments()
+            doc_count = sum(count for _, count in self.segments)
+            name = self.new_segment()
+            segment_dir = os.path.join(self.index_dir, name)
+            run_dir = os.path.join(segment_dir, 'runs')
+            os.mkdir(run_dir)
+
+            if self.debug:
+                immediate_print("indexing segment %(name)s" % {'name': name})
+            self.titles = []
+            run_files = self.invert(open(data_file, 'r', encoding = 'utf-8'), run_dir, doc_count)
+            if self.get_frequent() != set():
+                titles = self.titles
+                self.titles = []
+                run_files += self.invert(open(data_file, 'r', encoding = 'utf-8'), run_dir,
+                        doc_count, 'biword', self.get_frequent())
+                self.titles = titles
+            self.merge_runs(run_files, segment_dir)
+            for run_file in run_files:
+                os.remove(run_file)
+            os.rmdir(run_dir)
+            self.dump_titles(os.path.join(segment_dir, 'TITLES'))
+            self.write_segments(self.segments + [(name, len(self.titles))])
+        self.refresh()
+
+    def delete_documents(self, docs):
+        """Marks documents as deleted by appending tombstones to the index.
+
+        The postings of deleted documents are skipped while searching and
+        dropped for good when their segment gets merged."""
+        with self.lock():
+            with open(os.path.join(self.index_dir, 'DELETED'), 'ab') as handle:
+                handle.write(codec.encode_raw(sorted(docs)))
+        self.refresh()
+
+    @staticmethod
+    def choose_merge(segments, merge_factor):
+        """Chooses adjacent segments to merge with a size-tiered policy.
+
+        A segment belongs to the tier of the logarithm of its document count,
+        merge_factor adjacent segments of the same tier get merged into one of
+        the next tier. The base segment is only rebuilt by create_index.
+        Returns the index of the first segment to merge or None."""
+        run = 0
+        run_tier = None
+        for i, (name, doc_count) in enumerate(segments):
+            if name == BASE_SEGMENT:
+                run = 0
+                continue
+            tier = 0
+            while doc_count >= merge_factor:
+                doc_count //= merge_factor
+                tier += 1
+            if tier != run_tier:
+                run = 0
+                run_tier = tier
+            run += 1
+            if run == merge_factor:
+                return i - merge_factor + 1
+        return None
+
+    def merge_segments(self, merge_factor = 4):
+        """Merges segments until the size-tiered policy is satisfied.
 
+        The merged postings skip the deleted documents. Only one merge runs at
+        a time; searching and adding documents go on in the meantime, the
+        segment list is swapped atomically when a merge is done. Returns the
+        number of merges done."""
+        merges = 0
+        with self.lock('MERGE_LOCK', blocking = False) as locked:
+            while locked:
+                with self.lock():
+                    self.detect_segments()
+                    first = Indexer.choose_merge(self.segments, merge_factor)
+                    if first is None:
+                        break
+                    merged = self.segments[first:first + merge_factor]
+                    name = self.new_segment()
 
-    def initialize_morfologik(self, morfologik_filename):
-        """Generates morfologik dictionary from a file"""
-        if self.morfologik == {}:
-            morfologik_handle = open(morfologik_filename, 'r')
-            for line in morfologik_handle:
-                forms = line.rstrip().split(' ')
-                self.morfologik[forms[0]] = forms[1:]
+                if self.debug:
+                    immediate_print("merging segments %(names)s into %(name)s" %
+                            {'names': ' '.join(n for n, _ in merged), 'name': name})
+                self.write_merged(merged, name)
 
-    def generate_index_file(self, filename, out_filename):
-        """Generates unsorted index file with the word occurences"""
+                with self.lock():
+                    self.detect_segments()
+                    first = self.segments.index(merged[0])
+                    self.write_segments(self.segments[:first] +
+                            [(name, sum(count for _, count in merged))] +
+                            self.segments[first + merge_factor:])
+                for old_name, _ in merged:
+                    shutil.rmtree(os.path.join(self.index_dir, old_name))
+                merges += 1
+        self.refresh()
+        return merges
 
-        doc_count = 0
+    def start_merge(self, merge_factor = 4):
+        """Merges the segments in a background process, returns the process"""
+        context = multiprocessing.get_context('fork')
+        process = context.Process(target = self.merge_segments,
+                args = (merge_factor,))
+        process.start()
+        return process
+
+    def write_merged(self, segments, name):
+        """Writes the postings and titles of adjacent segments into a new one"""
+        segment_dir = os.path.join(self.index_dir, name)
+        segment_titles = []
+        for old_name, _ in segments:
+            store = titles.TitleStore(os.path.join(self.index_dir, old_name, 'TITLES'))
+            segment_titles.extend(store)
+            store.close()
+
+        def keys(old_name, seg_no):
+            '''Generator for the terms of a segment in order, with the partitions'''
+            for partition in self.partition_names(old_name):
+                dictionary = self.get_partition(partition, old_name)
+                if dictionary is not None:
+                    for i in range(len(dictionary)):
+                        yield dictionary.key(i), seg_no, i, dictionary
+
+        def postings():
+            records = [keys(old_name, seg_no)
+                    for seg_no, (old_name, _) in enumerate(segments)]
+            for key, group in itertools.groupby(heapq.merge(*records),
+                    lambda record: record[0]):
+                posting_list = [(doc, list(positions))
+                        for _, _, i, dictionary in group
+                        for doc, positions in self.decode_positional(dictionary.value(i))
+                        if doc not in self.deleted_set]
+                if posting_list != []:
+                    yield key.decode('utf-8'), posting_list
+
+        self.write_index(postings(), segment_dir)
+        titles.write_titles(os.path.join(segment_dir, 'TITLES'),
+                segment_titles, self.compressed)
+
+    def occurrences(self, lines, doc_count = 0):
+        """Generator for the (base, document, position) triples of the data"""
         word_regexp = re.compile(r'\w+')
-        file_handle = open(filename, 'r')
-        indexfile_handle = open(out_filename, 'w') 
         word_count = 0
-    
-        illegal_char_regexp = re.compile(r'[^0-9a-zęóąśłżźćń]')
 
-        for line in file_handle:
+        normalized = self.normalized
+        for line in lines:
             if line[:9] == '##TITLE##':
                 if self.debug and doc_count % 1000 == 0:
                     immediate_print('%(count)d documents indexed' 
@@ -137,190 +471,490 @@ class Indexer:
                 self.titles.append(line[10:].strip())
                 word_count = 0
             else:
-                for word in word_regexp.findall(line):
+                words = word_regexp.findall(line)
+                normalized.lookups += len(words)
+                for word in words:
                     word_count += 1
-                    bases = self.normalize(word)
-                    for base in bases:
-                        if illegal_char_regexp.search(base):
-                            continue
-                        indexfile_handle.write("%(b)s %(c)d %(p)d\n" %
-                            {'b': base, 'c': doc_count, 'p': word_count})
-
-    @staticmethod
-    def sort_file(filename, dest):
-        """Sorts the big index file"""
-        os.system("LC_ALL=C sort -T. -k1,1 -s " + filename + " > " + dest)
+                    for base in normalized[word]:
+                        yield base, doc_count, word_count
 
-    def generate_dicts(self, sorted_filename, out_dir, morfologik = False):
-        """Generates prefix dictionaries from the sorted index file"""
-        if not os.path.exists(out_dir):
-            os.mkdir(out_dir)
+    def biword_occurrences(self, lines, doc_count, frequent):
+        """Generator for the (biword, document, position) triples of the data.
 
-        indexfile_handle = open(sorted_filename)
-        index_dict = {}
-        prefix = ""
+        A biword is a pair of bases of adjacent words separated with a space,
+        only the pairs with a frequent base are generated. The position is the
+        one of the first word."""
+        previous = None
+        previous_bases = []
+        for key, group in itertools.groupby(self.occurrences(lines, doc_count),
+                lambda occurrence: occurrence[1:]):
+            doc, pos = key
+            bases = list(dict.fromkeys(base for base, _, _ in group))
+            if previous == (doc, pos - 1):
+                for first in previous_bases:
+                    for second in bases:
+                        if first in frequent or second in frequent:
+                            yield first + ' ' + second, doc, pos - 1
+            previous = key
+            previous_bases = bases
 
-        for i, line in enumerate(indexfile_handle):
-            if self.debug and i % 1000000 == 0:
-                immediate_print("%(count)d parsed lines" % {'count': i})
-            words = line.rstrip().split(' ')
-            key = words[0]
+    def choose_frequent(self, document_count):
+        """Chooses the terms to index the biwords for, as dense as the ones
+        stored as bitmaps"""
+        return set(term for term, count in self.term_counts.items()
+                if BITMAP_DENSITY * count >= document_count)
 
-            if not morfologik:
-                value = (int(words[1]), int(words[2]))
+    def get_frequent(self):
+        """Returns the set of the frequent terms with indexed biwords"""
+        if self.frequent is None:
+            filename = os.path.join(self.index_dir, 'FREQUENT')
+            if os.path.exists(filename):
+                with open(filename, 'r', encoding = 'utf-8') as handle:
+                    self.frequent = set(handle.read().split())
             else:
-                value = words[1:]
-            
-            if key[:self.prefix_len] == prefix:
-                if key in index_dict:
-                    if index_dict[key][-1][0] == value[0]:
-                        index_dict[key][-1][1].append(value[1])
-                    else:
-                        index_dict[key].append([value[0], [value[1]]])
-                else:
-                    if morfologik:
-                        index_dict[key] = value
-                    else:
-                        index_dict[key] = [[value[0], [value[1]]]]
-            else:
-                if prefix != "":
+                self.frequent = set()
+        return self.frequent
 
-                    if self.compressed and not morfologik:
-                        index_dict = Indexer.differentiate_dict(index_dict)
+    def invert_documents(self, data_file, run_dir, frequent = None):
+        """Inverts the words (or the biwords of the frequent terms) of the
+        data file, in parallel when possible"""
+        if self.workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            return self.invert_parallel(data_file, run_dir, frequent)
+        elif frequent is None:
+            return self.invert(open(data_file, 'r', encoding = 'utf-8'), run_dir)
+        else:
+            return self.invert(open(data_file, 'r', encoding = 'utf-8'), run_dir, 0, 'biword', frequent)
 
-                    self.dump(index_dict, os.path.join(out_dir, prefix))
-                    if not morfologik:
-                        self.dump(Indexer.deposition_dict(index_dict), os.path.join(out_dir, "%s.nopos" % prefix))
+    def invert(self, lines, run_dir, doc_count = 0, name = 'run', frequent = None):
+        """Inverts the documents in memory, flushing sorted runs to disk.
 
-                    if self.debug:
-                        immediate_print("dumping dict %(filename)s" % 
-                            {'filename': os.path.join(out_dir, prefix)})
+        The postings are kept as flat arrays of (document, position) pairs
+        and written out as a run whenever their estimated size exceeds the
+        memory budget (split between the workers). With the frequent terms
+        given the biwords are inverted instead of the words. Returns the names
+        of the run files in document order."""
+        postings = {}
+        used = 0
+        run_files = []
+        # the last documents of the counted terms, a document may span two runs
+        last_docs = {}
+        budget = self.memory_budget // self.workers
+        if frequent is None:
+            occurrences = self.occurrences(lines, doc_count)
+        else:
+            occurrences = self.biword_occurrences(lines, doc_count, frequent)
 
-                    index_dict.clear()
+        for base, doc, pos in occurrences:
+            pairs = postings.get(base)
+            if pairs is None:
+                pairs = postings[base] = array.array(codec.UINT32)
+                used += TERM_COST
+            pairs.append(doc)
+            pairs.append(pos)
+            used += 8
 
-                if morfologik:
-                    index_dict[key] = value
-                else:
-                    index_dict[key] = [[value[0], [value[1]]]]
-                prefix = key[:self.prefix_len]
+            if used > budget:
+                if self.biwords and frequent is None:
+                    self.count_terms(postings, last_docs)
+                run_files.append(self.flush_run(postings,
+                    run_dir, name, len(run_files)))
+                postings = {}
+                used = 0
 
-        if self.compressed and not morfologik:
-            index_dict = Indexer.differentiate_dict(index_dict)
-        self.dump(index_dict, os.path.join(out_dir, prefix))
-        if not morfologik:
-            self.dump(Indexer.deposition_dict(index_dict), os.path.join(out_dir, "%s.nopos" % prefix))
-    
-    @staticmethod
-    def deposition_dict(dic):
-        for key in dic:
-            dic[key] = list(Indexer.deposition_posting(dic[key]))
-        return dic
+        if postings != {} or run_files == []:
+            if self.biwords and frequent is None:
+                self.count_terms(postings, last_docs)
+            run_files.append(self.flush_run(postings,
+                run_dir, name, len(run_files)))
+        return run_files
 
-    @staticmethod
-    def deposition_posting(posting):
-        return [elem[0] for elem in posting]
+    def count_terms(self, postings, last_docs):
+        """Adds up the numbers of the documents containing the terms being
+        inverted, not counting again the last documents of the previous run"""
+        for term, pairs in postings.items():
+            docs = pairs[0::2]
+            count = len(set(docs))
+            if last_docs.get(term) == docs[0]:
+                count -= 1
+            last_docs[term] = docs[-1]
+            self.term_counts[term] = self.term_counts.get(term, 0) + count
+
+    def flush_run(self, postings, run_dir, name, run_no):
+        """Writes the postings inverted so far as a sorted run"""
+        run_file = os.path.join(run_dir, '%(name)s%(no)05d' %
+                {'name': name, 'no': run_no})
+        if self.debug:
+            immediate_print("flushing run %(filename)s" % {'filename': run_file})
+        runs.write_run(run_file, postings)
+        return run_file
+
+    def invert_parallel(self, filename, run_dir, frequent = None):
+        """Inverts shards of the documents in a pool of worker processes"""
+        shards = Indexer.split_documents(filename, self.workers)
+        global shard_indexer
+        shard_indexer = self
+        context = multiprocessing.get_context('fork')
+        with context.Pool(len(shards)) as pool:
+            results = pool.map(invert_shard, [(filename, start, end, doc_count,
+                run_dir, shard_no, frequent) for shard_no, (start, end, doc_count)
+                in enumerate(shards)])
+
+        run_files = []
+        for shard_run_files, shard_titles, term_counts in results:
+            run_files.extend(shard_run_files)
+            self.titles.extend(shard_titles)
+            for term, count in term_counts.items():
+                self.term_counts[term] = self.term_counts.get(term, 0) + count
+        return run_files
+
+    def invert_range(self, filename, start, end, doc_count, run_dir, shard_no,
+            frequent = None):
+        """Inverts the documents between two offsets of the data file"""
+        self.titles = []
+        self.term_counts = {}
+        run_files = self.invert(read_lines(filename, start, end), run_dir,
+                doc_count, 'shard%(no)03d_%(kind)s' % {'no': shard_no,
+                    'kind': 'run' if frequent is None else 'biword'}, frequent)
+        return run_files, self.titles, self.term_counts
 
     @staticmethod
-    def differentiate_dict(dic):
-        '''Differentiate posting lists in a dict'''
-        for key in dic:
-            dic[key] = list(Indexer.differentiate_posting(dic[key]))
-        return dic
+    def split_documents(filename, shards):
+        """Splits the data file into ranges of whole documents of similar size.
+
+        Returns (start offset, end offset, number of preceding documents)
+        triples."""
+        starts = []
+        size = 0
+        with open(filename, 'rb') as handle:
+            for line in handle:
+                if line[:9] == b'##TITLE##':
+                    starts.append(size)
+                size += len(line)
+
+        bounds = [0]
+        for shard in range(1, shards):
+            doc = bisect.bisect_left(starts, size * shard // shards)
+            if doc < len(starts) and starts[doc] > bounds[-1]:
+                bounds.append(starts[doc])
+        bounds.append(size)
+
+        ranges = []
+        for start, end in zip(bounds, bounds[1:]):
+            ranges.append((start, end, bisect.bisect_left(starts, start)))
+        return ranges
+
+    def merge_runs(self, run_files, out_dir):
+        """Merges the sorted runs into the prefix partitions of the index"""
+        records = [((key, run_no, pairs) for key, pairs in runs.read_run(run_file))
+                for run_no, run_file in enumerate(run_files)]
+        merged = heapq.merge(*records)
+
+        def postings():
+            for key, group in itertools.groupby(merged, lambda record: record[0]):
+                pairs = array.array(codec.UINT32)
+                for _, _, run_pairs in group:
+                    pairs.extend(run_pairs)
+                yield key.decode('utf-8'), Indexer.positional_posting(pairs)
+
+        self.write_index(postings(), out_dir)
 
     @staticmethod
-    def differentiate_posting(posting, nopos = False):
-        """Differentiaties posting lists"""
-        if not posting == []:
-            doc_counter = 0
-            if not nopos:
-                for elem in posting:
-                    doc = elem[0]
-                    pos = elem[1]
-                    ndoc = doc - doc_counter
-                    npos = list(Indexer.differentiate_posting(pos, nopos = True))
-                    doc_counter = doc
-                    yield (ndoc, npos)
+    def positional_posting(pairs):
+        """Groups flat (document, position) pairs into a positional posting"""
+        posting_list = []
+        for doc, pos in zip(pairs[0::2], pairs[1::2]):
+            if posting_list != [] and posting_list[-1][0] == doc:
+                posting_list[-1][1].append(pos)
             else:
-                for elem in posting:
-                    yield (elem - doc_counter)
-                    doc_counter = elem
+                posting_list.append((doc, [pos]))
+        return posting_list
+
+    def write_index(self, postings, out_dir):
+        """Writes sorted (term, positional posting) pairs into partitions.
+
+        Without the partition size the terms go to prefix partitions, with it
+        the sorted terms are cut into partitions of about that many bytes and
+        the first terms of the partitions are written to the PARTITIONS
+        table of the directory."""
+        if self.partition_size is not None:
+            self.write_sized_partitions(postings, out_dir)
+            return
+        table_file = os.path.join(out_dir, 'PARTITIONS')
+        if os.path.exists(table_file):
+            os.remove(table_file)
+
+        index_dict = {}
+        prefix = None
+        for term, posting_list in postings:
+            if term[:self.prefix_len] != prefix:
+                if index_dict != {}:
+                    self.dump_dicts(index_dict, out_dir, prefix)
+                index_dict = {}
+                prefix = term[:self.prefix_len]
+            index_dict[term] = posting_list
+        if index_dict != {}:
+            self.dump_dicts(index_dict, out_dir, prefix)
+
+    def write_sized_partitions(self, postings, out_dir):
+        """Writes sorted (term, positional posting) pairs into partitions of
+        about partition_size bytes and their boundary table"""
+        boundaries = []
+        entries = []
+        size = 0
+
+        def dump():
+            termdict.write_dictionary(os.path.join(out_dir,
+                PARTITION_NAME % {'no': len(boundaries) - 1}), iter(entries))
+
+        for term, posting_list in postings:
+            if entries == []:
+                boundaries.append(term)
+            entry = self.encode_entry(posting_list)
+            entries.append((term, entry))
+            size += len(term.encode('utf-8')) + len(entry)
+            if size >= self.partition_size:
+                dump()
+                entries = []
+                size = 0
+        if entries != []:
+            dump()
+
+        table_file = os.path.join(out_dir, 'PARTITIONS')
+        with open(table_file + '.tmp', 'w', encoding = 'utf-8') as handle:
+            handle.write(''.join(term + '\n' for term in boundaries))
+        os.replace(table_file + '.tmp', table_file)
 
     @staticmethod
-    def dedifferentiate_posting(posting, nopos = False):
-        """Dedifferentiates posting lists"""
-        if not posting == []:
-            doc_counter = 0
-            if nopos:
-                for elem in posting:
-                    doc_counter += elem
-                    yield(doc_counter)
-            else:
-                for elem in posting:
-                    doc = elem[0]
-                    pos = elem[1]
-                    doc_counter += doc
-                    npos = Indexer.dedifferentiate_posting(pos, nopos = True)
-                    yield (doc_counter, npos)
-
-    def dump(self, obj, filename):
-        """Dumps an object to a file"""
-        if self.compressed:
-            handle = gzip.open(filename, 'wb')
-        else:
-            handle = open(filename, 'wb')
-        marshal.dump(obj, handle, 2)
+    def sort_file(filename, dest):
+        """Sorts the big index file"""
+        os.system("LC_ALL=C sort -T. -k1,1 -s " + filename + " > " + dest)
 
-    def load(self, filename):
-        """Loads an object from a file"""
-        if self.compressed:
-            handle = gzip.open(filename, 'rb')
+    def generate_dicts(self, sorted_filename, filename):
+        """Generates the lemma dictionary from the sorted morfologik file.
+
+        It is a term dictionary mapping the words to their bases separated
+        with spaces, the first line of a word wins."""
+        if self.morfologik is not None:
+            self.morfologik.close()
+            self.morfologik = None
+
+        def items():
+            key = None
+            for i, line in enumerate(open(sorted_filename)):
+                if self.debug and i % 1000000 == 0:
+                    immediate_print("%(count)d parsed lines" % {'count': i})
+                words = line.rstrip().split(' ')
+                if words[0] != key:
+                    key = words[0]
+                    yield key, ' '.join(words[1:]).encode('utf-8')
+
+        termdict.write_dictionary(filename, items())
+
+    def dump_dicts(self, index_dict, out_dir, prefix):
+        """Dumps a prefix dictionary as a term dictionary file"""
+        terms = sorted(index_dict, key = lambda term: term.encode('utf-8'))
+        termdict.write_dictionary(os.path.join(out_dir, prefix), ((term,
+            self.encode_entry(index_dict[term])) for term in terms))
+
+    def encode_entry(self, posting_list):
+        """Encodes the document frequency and the posting of a term.
+
+        The documents of the terms dense enough are kept as a bitmap followed
+        by the counts and the positions, so that they can be merged a machine
+        word at a time."""
+        count = len(posting_list)
+        # the density is measured over the documents spanned by the posting,
+        # the segments added later start far from document 0
+        if (count >= codec.BLOCK_SIZE and BITMAP_DENSITY * count >=
+                posting_list[-1][0] - posting_list[0][0] + 1):
+            encoded = codec.encode_bitmap([doc for doc, _ in posting_list])
+            if self.compressed:
+                encoded += codec.encode_positions(posting_list)
+            else:
+                encoded += codec.encode_raw_positions(posting_list)
+            return ENTRY_HEADER.pack(count | BITMAP_ENTRY) + encoded
+        elif self.compressed:
+            encoded = codec.encode_positional(posting_list)
         else:
-            handle = open(filename, 'rb')
-        return marshal.load(handle)
+            encoded = codec.encode_raw_positional(posting_list)
+        return ENTRY_HEADER.pack(count) + encoded
 
     def load_to_morfologik_cache(self, words, prefix):
-        '''morfologik wrapper to load_to_cache'''
-        if words != []:
-            filename = os.path.join(self.index_dir, 'morfologik', prefix)
-            self.load_to_cache(self.morfologik_cache, words, filename)
+        '''Loads the bases of the words missing from the morfologik cache'''
+        for word in words:
+            if word not in self.normalized and word not in self.morfologik_cache:
+                self.morfologik_cache[word] = self.read_morfologik(word)
+
+    def read_morfologik(self, word):
+        '''Reads the bases of a word from the memory mapped lemma dictionary'''
+        if self.morfologik is None:
+            filename = os.path.join(self.index_dir, 'MORFOLOGIK')
+            if not os.path.exists(filename):
+                return [word]
+            self.morfologik = termdict.TermDictionary(filename)
+
+        self.stats.add('morfologik_reads')
+        value = self.morfologik.get(word)
+        if value is None:
+            return [word]
+        elif len(value) == 0:
+            return []
+        return str(value, 'utf-8').split(' ')
 
     def load_to_index_cache(self, words, prefix):
-        '''index wrapper to load_to_cache'''
-        if words != []:
-            filename = os.path.join(self.index_dir, prefix)
-            self.load_to_cache(self.index_cache, words, filename)
+        '''Decodes the positional postings of the words into the cache, the
+        frequent ones are left for when a phrase cannot use the biwords'''
+        for word in words:
+            if word not in self.index_cache and word not in self.get_frequent():
+                self.get_positional_posting(word)
 
     def load_to_index_nopos_cache(self, words, prefix):
-        '''index nopos wrapper to load_to_cache'''
-        if words != []:
-            filename = os.path.join(self.index_dir, "%s.nopos" % prefix)
-            self.load_to_cache(self.index_nopos_cache, words, filename)
-
-    def load_to_cache(self, cache, words, filename):
-        '''Load the info about words from a file to a cache'''
-        if os.path.exists(filename):
-            dic = self.load(filename)
-            for word in words:
-                if word in dic:
-                    cache[word] = dic[word]
+        '''Decodes the postings of the words into the cache'''
+        for word in words:
+            if word not in self.index_nopos_cache:
+                self.get_posting(word)
+
+    def partition_table(self, segment = BASE_SEGMENT):
+        '''Returns the encoded first terms of the partitions of a segment cut
+        by size, None if the segment has prefix partitions'''
+        if segment not in self.partition_tables:
+            table_file = os.path.join(self.index_dir, segment, 'PARTITIONS')
+            if os.path.exists(table_file):
+                with open(table_file, 'r', encoding = 'utf-8') as handle:
+                    table = [line.rstrip('\n').encode('utf-8') for line in handle]
+            else:
+                table = None
+            self.partition_tables[segment] = table
+        return self.partition_tables[segment]
+
+    def partition_name(self, word, segment = BASE_SEGMENT):
+        '''Returns the name of the partition of a segment that can hold a word'''
+        table = self.partition_table(segment)
+        if table is None:
+            return word[:self.prefix_len]
+        no = bisect.bisect_right(table, word.encode('utf-8')) - 1
+        return PARTITION_NAME % {'no': max(no, 0)}
+
+    def partition_names(self, segment = BASE_SEGMENT):
+        '''Returns the names of the partitions of a segment in the term order'''
+        table = self.partition_table(segment)
+        if table is not None:
+            return [PARTITION_NAME % {'no': no} for no in range(len(table))]
+        # the prefixes are lower case words, the other files of the index are not
+        segment_dir = os.path.join(self.index_dir, segment)
+        names = [name for name in os.listdir(segment_dir)
+                if name == name.lower() and '.' not in name
+                and os.path.isfile(os.path.join(segment_dir, name))]
+        return sorted(names, key = lambda name: name.encode('utf-8'))
+
+    def prefix_partitions(self, prefix, segment = BASE_SEGMENT):
+        '''Returns the names of the partitions of a segment that can hold the
+        terms starting with a prefix, in the term order'''
+        table = self.partition_table(segment)
+        if table is not None:
+            first = max(bisect.bisect_right(table, prefix.encode('utf-8')) - 1, 0)
+            return [PARTITION_NAME % {'no': no} for no in range(first, len(table))]
+        if len(prefix) >= self.prefix_len:
+            return [prefix[:self.prefix_len]]
+        return [name for name in self.partition_names(segment) if name.startswith(prefix)]
+
+    def prefix_terms(self, prefix, segment = BASE_SEGMENT):
+        '''Generator for the encoded terms of a segment starting with a prefix,
+        in order, read from the first one found with a binary search'''
+        key = prefix.encode('utf-8')
+        for name in self.prefix_partitions(prefix, segment):
+            dictionary = self.get_partition(name, segment)
+            if dictionary is None:
+                continue
+            for i in range(dictionary.find(prefix), len(dictionary)):
+                term = dictionary.key(i)
+                if not term.startswith(key):
+                    return
+                yield term
+
+    def expand_prefix(self, prefix, limit = None):
+        """Returns the sorted terms of the index starting with a prefix.
+
+        Only the first limit terms are returned if the limit is given, the
+        biword terms are skipped."""
+        terms = set()
+        for segment, _ in self.segments:
+            words = (term for term in self.prefix_terms(prefix, segment) if b' ' not in term)
+            terms.update(itertools.islice(words, limit))
+        terms = sorted(terms)[:limit]
+        self.stats.add('expansions', len(terms))
+        return [term.decode('utf-8') for term in terms]
+
+    def get_partition(self, prefix, segment = BASE_SEGMENT):
+        '''Opens the term dictionary of a partition, None if there is none'''
+        filename = os.path.join(self.index_dir, segment, prefix)
+        self.stats.note('prefix_files', os.path.join(segment, prefix))
+        if filename in self.partitions:
+            return self.partitions[filename]
+
+        self.stats.add('partitions_opened')
+        if os.path.isfile(filename):
+            dictionary = termdict.TermDictionary(filename)
+        else:
+            dictionary = None
+        self.partitions[filename] = dictionary
+        return dictionary
+
+    def get_entries(self, word):
+        '''Gets the index entries of a word from all the segments, in order'''
+        entries = []
+        if word == '':
+            # the empty word has no partition, it would name the segment directory
+            return entries
+        for segment, _ in self.segments:
+            dictionary = self.get_partition(self.partition_name(word, segment), segment)
+            if dictionary is not None:
+                entry = dictionary.get(word)
+                if entry is not None:
+                    entries.append(entry)
+        return entries
+
+    def cache_stats(self):
+        '''Returns the counters of the caches'''
+        return {'morfologik': self.morfologik_cache.stats(),
+                'postings': self.index_nopos_cache.stats(),
+                'positional': self.index_cache.stats(),
+                'partitions': self.partitions.stats(),
+                'normalized': self.normalized.stats()}
+
+    def close(self):
+        '''Empties the caches and unmaps the opened partitions'''
+        self.index_cache.clear()
+        self.index_nopos_cache.clear()
+        for dictionary, _ in self.partitions.entries.values():
+            if dictionary is not None:
+                dictionary.close()
+        self.partitions.clear()
+        self.partition_tables = {}
 
     def lemmatize(self, word):
         """Lemmatize a word"""
-        if self.morfologik != {}:
-            morfologik = self.morfologik
-        else:
-            morfologik = self.morfologik_cache
-        
-        return morfologik.get(word, [word])
+        bases = self.morfologik_cache.get(word)
+        if bases is None:
+            bases = self.read_morfologik(word)
+            self.morfologik_cache[word] = bases
+        return bases
 
     def normalize(self, word):
-        """Normalizes and possibly stems the word"""
-        lemmated = self.lemmatize(word.lower())
+        """Returns the bases (possibly stemmed) of a word that can be indexed.
 
+        The bases are memoized by the surface form of the word, so that the
+        lowercasing, the morfologik lookup, the stemming and the check of the
+        characters are done once for a form and not for every occurrence."""
+        self.normalized.lookups += 1
+        return self.normalized[word]
+
+    def normalize_form(self, word):
+        """Computes the bases of a surface form for the normalization memo"""
+        lemmated = self.lemmatize(word.lower())
         if self.stemmed:
-            return (self.stem(word) for word in lemmated)
-        else:
-            return lemmated
+            lemmated = (self.stem(base) for base in lemmated)
+        return tuple(sys.intern(base) for base in lemmated if not ILLEGAL_CHAR.search(base))
     
     def stem(self, word):
         """Stems the word"""
@@ -334,35 +968,378 @@ class Indexer:
             return word
     
     def dump_titles(self, filename):
-        """Dumps titles info into a marshalled file"""
-        self.dump(self.titles, filename)
+        """Dumps the titles into a titles store file"""
+        titles.write_titles(filename, self.titles, self.compressed)
 
     def load_titles(self, filename):
-        """Loads the titles count info"""
-        self.titles = self.load(filename)
-        self.document_count = len(self.titles)
+        """Opens the titles stores of the base segment and the added segments,
+        the titles themselves are read only when needed"""
+        for store in self.title_stores:
+            store.close()
+        self.title_stores = [titles.TitleStore(filename)]
+        for segment, _ in self.segments:
+            if segment != BASE_SEGMENT:
+                self.title_stores.append(titles.TitleStore(
+                    os.path.join(self.index_dir, segment, 'TITLES')))
+
+        self.title_starts = []
+        self.document_count = 0
+        for store in self.title_stores:
+            self.title_starts.append(self.document_count)
+            self.document_count += len(store)
+        self.titles_file = filename
 
     def get_title(self, article_number):
-        """Gets a title from a marshalled file"""
-        return self.titles[article_number - 1]
+        """Gets a title from the titles store of its segment"""
+        store_no = bisect.bisect_right(self.title_starts, article_number - 1) - 1
+        return self.title_stores[store_no][article_number - 1 -
+                self.title_starts[store_no]]
     
+    def decode_positional(self, entry):
+        """Generator for the (document, positions) pairs of an index entry"""
+        count, bitmap = entry_header(entry)
+        self.stats.add('bytes_read', len(entry))
+        if bitmap:
+            docs = codec.decode_bitmap(codec.bitmap_data(entry, ENTRY_HEADER.size),
+                    codec.bitmap_base(entry, ENTRY_HEADER.size))
+            offset = ENTRY_HEADER.size + codec.bitmap_size(entry, ENTRY_HEADER.size)
+            if self.compressed:
+                # the counts and the gaps of the positions
+                self.stats.add('bytes_decompressed', codec.decoded_size(entry, offset, 2))
+                return codec.decode_positions(entry, docs, offset)
+            else:
+                return codec.decode_raw_positions(entry, docs, offset)
+        elif self.compressed:
+            self.stats.add('bytes_decompressed', codec.decoded_size(entry,
+                ENTRY_HEADER.size, 3))
+            return codec.decode_positional(entry, ENTRY_HEADER.size)
+        else:
+            return codec.decode_raw_positional(entry, count, ENTRY_HEADER.size)
+
+    def decode_docs(self, entry):
+        """Decodes the documents of an index entry, a bitmap is not copied"""
+        count, bitmap = entry_header(entry)
+        self.stats.add('bytes_read', len(entry))
+        if self.compressed and not bitmap:
+            self.stats.add('bytes_decompressed', 4 * count)
+        if bitmap:
+            return posting.Bitmap(codec.bitmap_data(entry, ENTRY_HEADER.size), count,
+                    codec.bitmap_base(entry, ENTRY_HEADER.size))
+        elif self.compressed:
+            return codec.decode(entry, offset = ENTRY_HEADER.size)
+        else:
+            return codec.decode_raw(entry, count, ENTRY_HEADER.size)
+
     def get_positional_posting(self, word):
         """Gets a document posting with positions for a given word"""
-        if self.compressed:
-            posting = Indexer.dedifferentiate_posting(copy.copy(self.index_cache.get(word, [])))
-        else:
-            posting = copy.copy(self.index_nopos_cache.get(word, []))
-        for doc in posting:
-            yield doc
-    
+        positional = self.index_cache.get(word)
+        if positional is None:
+            positional = [pair for entry in self.get_entries(word)
+                    for pair in self.decode_positional(entry)]
+            if self.deleted != []:
+                positional = [(doc, positions) for doc, positions in positional
+                        if doc not in self.deleted_set]
+            self.stats.add('positional_postings')
+            self.stats.add('positional_length', len(positional))
+            self.index_cache[word] = positional
+        return iter(positional)
+
     def get_posting(self, word):
-        """Gets a document posting without positions for a given word"""
-        if self.compressed:
-            posting = Indexer.dedifferentiate_posting(copy.copy(self.index_nopos_cache.get(word, [])), nopos = True)
-        else:
-            posting = copy.copy(self.index_nopos_cache.get(word, []))
-        for doc in posting:
-            yield doc
+        """Gets a document posting without positions for a given word.
+
+        The postings of the segments cover consecutive ranges of documents,
+        so they are simply concatenated (or or-ed into a bitmap). Dense terms
+        are returned as bitmaps."""
+        docs = self.index_nopos_cache.get(word)
+        if docs is None:
+            entries = self.get_entries(word)
+            if entries == []:
+                return posting.Posting([])
+            count, bitmap = entry_header(entries[0])
+            if len(entries) == 1 and self.deleted == []:
+                if (self.compressed and not bitmap and
+                        4 * count > self.index_nopos_cache.budget):
+                    # too big to be cached, decode only the blocks needed
+                    self.stats.add('postings')
+                    self.stats.add('posting_length', count)
+                    self.stats.add('bytes_read', ENTRY_HEADER.size +
+                            codec.table_size(entries[0], ENTRY_HEADER.size))
+                    return posting.BlockPosting(entries[0], ENTRY_HEADER.size,
+                            self.count_decoded)
+                docs = self.decode_docs(entries[0])
+            elif any(entry_header(entry)[1] for entry in entries):
+                parts = [self.decode_docs(entry) for entry in entries]
+                docs = posting.to_bitmap(parts[0])
+                for part in parts[1:]:
+                    docs = posting.union(docs, part)
+                if self.deleted != []:
+                    docs = posting.difference(docs, self.deleted)
+            else:
+                docs = array.array(codec.UINT32)
+                for entry in entries:
+                    docs.extend(doc for doc in self.decode_docs(entry)
+                            if doc not in self.deleted_set)
+            self.stats.add('postings')
+            self.stats.add('posting_length', len(docs))
+            self.index_nopos_cache[word] = docs
+        if isinstance(docs, posting.Bitmap):
+            return docs
+        return posting.Posting(docs)
+
+    def count_decoded(self, read, decoded):
+        '''Counts the bytes read and decoded from a posting decoded in blocks,
+        for the query searched at the moment'''
+        self.stats.add('bytes_read', read)
+        self.stats.add('bytes_decompressed', decoded)
+
+    def get_df(self, word):
+        """Gets the document frequency of a given word, summed over the
+        segments (the deleted documents are counted until merged away)"""
+        return sum(entry_header(entry)[0] for entry in self.get_entries(word))
+
+class IndexerTest(unittest.TestCase):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp()
+        os.write(handle, ''.join('##TITLE## Doc %(no)d\nzażółć %(no)d\n' % {'no': no}
+            for no in range(1, 11)).encode('utf-8'))
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    @staticmethod
+    def write_data(filename, texts, first = 1):
+        '''Writes the documents with the texts, titled with their numbers'''
+        with open(filename, 'w', encoding = 'utf-8') as handle:
+            for no, text in enumerate(texts, first):
+                handle.write('##TITLE## Doc %(no)d\n%(text)s\n' % {'no': no, 'text': text})
+
+    def test_segments(self):
+        workdir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        indexer = Indexer()
+        try:
+            with open('morfologik.txt', 'w', encoding = 'utf-8') as handle:
+                handle.write('koty kot\nkota kot\npsy pies\n')
+            IndexerTest.write_data('data.txt', ['kot ma psy', 'ala ma kota', 'pies'])
+            indexer.create_index('data.txt', 'morfologik.txt')
+            indexer.detect_segments()
+            indexer.load_titles('TITLES')
+            IndexerTest.write_data('first.txt', ['koty i psy', 'żółw'], 4)
+            indexer.add_documents('first.txt')
+            IndexerTest.write_data('second.txt', ['kot', 'ala'], 6)
+            indexer.add_documents('second.txt')
+            indexer.delete_documents([2, 5])
+
+            def check():
+                self.assertEqual(indexer.document_count, 7)
+                self.assertEqual([indexer.get_title(doc) for doc in range(1, 8)],
+                        ['Doc %(no)d' % {'no': no} for no in range(1, 8)])
+                self.assertEqual(list(indexer.get_posting('kot')), [1, 4, 6])
+                self.assertEqual(list(indexer.get_posting('pies')), [1, 3, 4])
+                self.assertEqual(list(indexer.get_posting('żółw')), [])
+                self.assertEqual([(doc, list(positions)) for doc, positions
+                    in indexer.get_positional_posting('ala')], [(7, [1])])
+                # the deleted documents are counted until their segment is merged
+                self.assertEqual(indexer.get_df('kot'), 4)
+
+            check()
+            self.assertEqual(indexer.get_df('żółw'), 1)
+            self.assertEqual([count for _, count in indexer.segments], [3, 2, 2])
+            self.assertEqual(indexer.merge_segments(2), 1)
+            self.assertEqual([count for _, count in indexer.segments], [3, 4])
+            check()
+            self.assertEqual(indexer.get_df('żółw'), 0)
+            self.assertEqual(indexer.merge_segments(2), 0)
+        finally:
+            indexer.close()
+            os.chdir(cwd)
+            shutil.rmtree(workdir)
+
+    def test_count_terms(self):
+        lines = ['##TITLE## Doc 1\n', 'kot kot kot kot pies\n', '##TITLE## Doc 2\n',
+                'pies\n', '##TITLE## Doc 3\n', 'pies\n']
+        run_dir = tempfile.mkdtemp()
+        indexer = Indexer(index_dir = run_dir, biwords = True, memory_budget = 0)
+        try:
+            # every occurrence is flushed as a run of its own
+            self.assertEqual(len(indexer.invert(iter(lines), run_dir)), 7)
+        finally:
+            shutil.rmtree(run_dir)
+        self.assertEqual(indexer.term_counts, {'kot': 1, 'pies': 3})
+        self.assertEqual(indexer.choose_frequent(16), {'kot', 'pies'})
+        self.assertEqual(indexer.choose_frequent(17), {'pies'})
+
+    @unittest.skipIf('fork' not in multiprocessing.get_all_start_methods(),
+            "The parallel build needs fork")
+    def test_parallel_build(self):
+        workdir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            with open('morfologik.txt', 'w', encoding = 'utf-8') as handle:
+                handle.write('koty kot\nkota kot\npsy pies\nżółwie żółw\n')
+            IndexerTest.write_data('data.txt', ['kot ma psy ' * (no % 3 + 1) +
+                'żółwie zażółć gęślą jaźń %(no)d' % {'no': no} for no in range(30)])
+            files = {}
+            for workers in [1, 3]:
+                index_dir = 'index%(workers)d' % {'workers': workers}
+                indexer = Indexer(index_dir = index_dir, compressed = True,
+                        biwords = True, workers = workers)
+                indexer.create_index('data.txt', 'morfologik.txt')
+                indexer.close()
+                os.rename('TITLES', os.path.join(index_dir, 'TITLES'))
+                files[workers] = {}
+                for root, _, names in os.walk(index_dir):
+                    for name in names:
+                        with open(os.path.join(root, name), 'rb') as handle:
+                            files[workers][os.path.relpath(os.path.join(root, name),
+                                index_dir)] = handle.read()
+            self.assertTrue('FREQUENT' in files[1])
+            self.assertEqual(files[1], files[3])
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir)
+
+    def test_split_documents(self):
+        shards = Indexer.split_documents(self.filename, 3)
+        self.assertEqual(len(shards), 3)
+        lines = []
+        for start, end, doc_count in shards:
+            shard = list(read_lines(self.filename, start, end))
+            self.assertTrue(shard[0].startswith('##TITLE##'))
+            self.assertEqual(doc_count, ''.join(lines).count('##TITLE##'))
+            lines += shard
+        self.assertEqual(''.join(lines), open(self.filename, encoding = 'utf-8').read())
+
+    def test_split_too_many(self):
+        self.assertEqual(len(Indexer.split_documents(self.filename, 20)), 10)
+
+    def test_lemmatize(self):
+        index_dir = tempfile.mkdtemp()
+        sorted_file = os.path.join(index_dir, 'MORFOLOGIK.sorted')
+        with open(sorted_file, 'w') as handle:
+            handle.write('domem dom\nkot kot\nkoty kot\nkoty kota\nnic\nżółwie żółw\n')
+        indexer = Indexer(index_dir = index_dir)
+        try:
+            indexer.generate_dicts(sorted_file, os.path.join(index_dir, 'MORFOLOGIK'))
+            self.assertEqual(indexer.lemmatize('koty'), ['kot'])
+            self.assertEqual(indexer.lemmatize('żółwie'), ['żółw'])
+            self.assertEqual(indexer.lemmatize('nic'), [])
+            self.assertEqual(indexer.lemmatize('pies'), ['pies'])
+            self.assertEqual(indexer.cache_stats()['morfologik']['entries'], 4)
+        finally:
+            indexer.morfologik.close()
+            shutil.rmtree(index_dir)
+
+    def test_normalize(self):
+        index_dir = tempfile.mkdtemp()
+        sorted_file = os.path.join(index_dir, 'MORFOLOGIK.sorted')
+        with open(sorted_file, 'w') as handle:
+            handle.write('koty kot kota\nnic\nstraße straße\n')
+        indexer = Indexer(index_dir = index_dir, normalized_forms = 3)
+        try:
+            indexer.generate_dicts(sorted_file, os.path.join(index_dir, 'MORFOLOGIK'))
+            self.assertEqual(indexer.normalize('Koty'), ('kot', 'kota'))
+            self.assertEqual(indexer.normalize('Koty'), ('kot', 'kota'))
+            self.assertEqual(indexer.normalize('nic'), ())
+            self.assertEqual(indexer.normalize('straße'), ())
+            self.assertEqual(indexer.normalize('pies'), ('pies',))
+            stats = indexer.cache_stats()['normalized']
+            self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 4, 1))
+            self.assertEqual(indexer.cache_stats()['morfologik']['misses'], 4)
+        finally:
+            indexer.morfologik.close()
+            shutil.rmtree(index_dir)
+
+    def test_choose_merge(self):
+        segments = [(BASE_SEGMENT, 1000), ('a', 40), ('b', 10), ('c', 12), ('d', 9)]
+        self.assertEqual(Indexer.choose_merge(segments, 4), None)
+        self.assertEqual(Indexer.choose_merge(segments + [('e', 5)], 4), 2)
+        self.assertEqual(Indexer.choose_merge(segments + [('e', 50)], 4), None)
+        self.assertEqual(Indexer.choose_merge([(BASE_SEGMENT, 1)] + segments[2:], 3), 1)
+
+    def test_bitmap_entry(self):
+        posting_list = [(doc, [1, doc % 7 + 2]) for doc in range(100000, 100000
+            + 4 * codec.BLOCK_SIZE, 4)]
+        for compressed in [False, True]:
+            indexer = Indexer(compressed = compressed)
+            entry = indexer.encode_entry(posting_list)
+            self.assertTrue(entry_header(entry)[1])
+            self.assertTrue(len(entry) < 100000 // 8)
+            docs = indexer.decode_docs(entry)
+            self.assertEqual(list(docs), [doc for doc, _ in posting_list])
+            self.assertEqual([(doc, list(positions)) for doc, positions
+                in indexer.decode_positional(entry)], posting_list)
+        sparse = [(doc, [1]) for doc in range(1, 100 * codec.BLOCK_SIZE, 100)]
+        self.assertFalse(entry_header(Indexer().encode_entry(sparse))[1])
+
+    def test_positional_posting(self):
+        pairs = array.array(codec.UINT32, [1, 2, 1, 5, 3, 1])
+        self.assertEqual(Indexer.positional_posting(pairs), [(1, [2, 5]), (3, [1])])
+
+    def test_empty_word(self):
+        index_dir = tempfile.mkdtemp()
+        indexer = Indexer(index_dir = index_dir)
+        try:
+            indexer.write_index(iter([('kot', [(1, [1]), (3, [2])])]), index_dir)
+            indexer.document_count = 3
+            self.assertEqual(list(indexer.get_posting('')), [])
+            self.assertEqual(indexer.get_df(''), 0)
+            self.assertEqual(indexer.get_partition(''), None)
+        finally:
+            indexer.close()
+            shutil.rmtree(index_dir)
+
+    def test_sized_partitions(self):
+        index_dir = tempfile.mkdtemp()
+        terms = sorted(['ala', 'alan', 'kot', 'kota', 'koty', 'ma', 'pies', 'zażółć',
+            'ala ma', 'żółw'], key = lambda term: term.encode('utf-8'))
+        postings = [(term, [(no, [1]), (no + 1, [2, 3])]) for no, term in enumerate(terms)]
+        indexer = Indexer(index_dir = index_dir, partition_size = 40)
+        try:
+            indexer.write_index(iter(postings), index_dir)
+            names = indexer.partition_names()
+            self.assertTrue(len(names) > 2)
+            with open(os.path.join(index_dir, 'PARTITIONS'), encoding = 'utf-8') as handle:
+                self.assertEqual(len(handle.readlines()), len(names))
+            for term, posting_list in postings:
+                self.assertTrue(indexer.partition_name(term) in names)
+                entries = indexer.get_entries(term)
+                self.assertEqual(len(entries), 1)
+                self.assertEqual([(doc, list(positions)) for doc, positions
+                    in indexer.decode_positional(entries[0])], posting_list)
+                del entries
+            self.assertEqual(indexer.get_entries('a'), [])
+            self.assertEqual(indexer.get_entries('kotek'), [])
+            self.assertEqual(indexer.get_entries('źrebię'), [])
+        finally:
+            indexer.close()
+            shutil.rmtree(index_dir)
+
+    def test_expand_prefix(self):
+        terms = sorted(['ala', 'alan', 'kot', 'kota', 'koty', 'ma', 'pies', 'zażółć',
+            'ala ma', 'żółw'], key = lambda term: term.encode('utf-8'))
+        for partition_size in [None, 40]:
+            index_dir = tempfile.mkdtemp()
+            os.mkdir(os.path.join(index_dir, 'segments'))
+            open(os.path.join(index_dir, 'FREQUENT'), 'w').close()
+            indexer = Indexer(index_dir = index_dir, prefix_len = 2,
+                    partition_size = partition_size)
+            try:
+                indexer.write_index(((term, [(1, [1])]) for term in terms), index_dir)
+                self.assertEqual(indexer.expand_prefix('ko'), ['kot', 'kota', 'koty'])
+                self.assertEqual(indexer.expand_prefix('kot'), ['kot', 'kota', 'koty'])
+                self.assertEqual(indexer.expand_prefix('k', 2), ['kot', 'kota'])
+                self.assertEqual(indexer.expand_prefix('al'), ['ala', 'alan'])
+                self.assertEqual(indexer.expand_prefix('', 2), ['ala', 'alan'])
+                self.assertEqual(indexer.expand_prefix('ż'), ['żółw'])
+                self.assertEqual(indexer.expand_prefix('x'), [])
+                self.assertEqual(indexer.expand_prefix('s'), [])
+            finally:
+                indexer.close()
+                shutil.rmtree(index_dir)
 
 def main():
     """Does some indexer testing"""
@@ -372,7 +1349,6 @@ def main():
        'data/morfologik_do_wyszukiwarek.txt')
     #indexer.create_index('data/wiki100k',
     #indexer.load_to_index_cache('w', 'w')
-    #indexer.load_to_index_nopos_cache('w', 'w')
     #print(list(indexer.get_positional_posting('w')))
     #print(list(indexer.get_posting('w')))
 
@@ -0,0 +1,468 @@
+#!/usr/bin/python3.1 -OO
+'''File for the posting list classes with skip-aware cursors and tests for them'''
+import unittest
+import array
+import bisect
+import heapq
+import itertools
+import re
+import codec
+
+NONZERO = re.compile(b'[^\x00]')
+
+def length(docs):
+    '''Returns the length of a document list, infinite for generators'''
+    try:
+        return len(docs)
+    except TypeError:
+        return float('inf')
+
+def cursor(docs):
+    '''Returns the best cursor available for a document list'''
+    if isinstance(docs, (Posting, BlockPosting, Complement, Bitmap)):
+        return docs.cursor()
+    elif isinstance(docs, list):
+        return ListCursor(docs)
+    else:
+        return IterCursor(docs)
+
+class Posting:
+    '''A sorted document posting kept as a plain list'''
+    def __init__(self, docs):
+        self.docs = docs
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        return iter(self.docs)
+
+    def cursor(self):
+        '''Returns a cursor galloping over the posting'''
+        return ListCursor(self.docs)
+
+class BlockPosting:
+    '''A sorted document posting encoded with the block codec, the numbers of
+    bytes read and decoded are passed to on_decode when it is given'''
+    def __init__(self, buf, offset = 0, on_decode = None):
+        self.buf = buf
+        self.offset = offset
+        self.on_decode = on_decode
+
+    def __len__(self):
+        return codec.count(self.buf, self.offset)
+
+    def __iter__(self):
+        if self.on_decode is not None:
+            self.on_decode(codec.blob_size(self.buf, self.offset) -
+                    codec.table_size(self.buf, self.offset), 4 * len(self))
+        return iter(codec.decode(self.buf, offset = self.offset))
+
+    def cursor(self):
+        '''Returns a cursor skipping over the blocks of the posting'''
+        return BlockCursor(self.buf, self.offset, self.on_decode)
+
+def materialize(docs):
+    '''Returns a document list that can be iterated many times'''
+    if isinstance(docs, (list, Bitmap)):
+        return docs
+    return list(docs)
+
+def to_bitmap(docs):
+    '''Converts a sorted document list to a bitmap'''
+    if isinstance(docs, Bitmap):
+        return docs
+    docs = materialize(docs)
+    encoded = codec.encode_bitmap(docs)
+    return Bitmap(codec.bitmap_data(encoded), len(docs), codec.bitmap_base(encoded))
+
+def union(docs1, docs2):
+    '''Or-merges two document lists of which at least one is a bitmap'''
+    if not isinstance(docs1, Bitmap):
+        docs1, docs2 = docs2, docs1
+    if isinstance(docs2, Bitmap):
+        return Bitmap.from_int(docs1.to_int() | docs2.to_int())
+
+    data = bytearray(docs1.data)
+    base = docs1.base
+    for doc in docs2:
+        byte_no = (doc >> 3) - base
+        if byte_no < 0:
+            # the documents are sorted, the bitmap grows to the left only once
+            data[0:0] = bytes(-byte_no)
+            base += byte_no
+            byte_no = 0
+        elif byte_no >= len(data):
+            data.extend(bytes(byte_no + 1 - len(data)))
+        data[byte_no] |= 1 << (doc & 7)
+    return Bitmap(data, base = base)
+
+def union_all(doc_lists):
+    '''Or-merges any number of document lists at once, the bitmaps with one
+    integer or and the other lists with one heap'''
+    bitmaps = [docs for docs in doc_lists if isinstance(docs, Bitmap)]
+    lists = [docs for docs in doc_lists if not isinstance(docs, Bitmap)]
+    if bitmaps == [] and len(lists) <= 1:
+        return lists[0] if lists else []
+    merged = (doc for doc, _ in itertools.groupby(heapq.merge(*lists)))
+    if bitmaps == []:
+        return merged
+    bits = 0
+    for bitmap in bitmaps:
+        bits |= bitmap.to_int()
+    return union(Bitmap.from_int(bits), merged)
+
+def intersection(docs1, docs2):
+    '''And-merges two document lists of which at least one is a bitmap'''
+    if not isinstance(docs1, Bitmap):
+        docs1, docs2 = docs2, docs1
+    if isinstance(docs2, Bitmap):
+        return Bitmap.from_int(docs1.to_int() & docs2.to_int())
+    return [doc for doc in docs2 if doc in docs1]
+
+def difference(docs1, docs2):
+    '''Subtracts two document lists of which at least one is a bitmap'''
+    if isinstance(docs1, Bitmap) and isinstance(docs2, Bitmap):
+        return Bitmap.from_int(docs1.to_int() & ~docs2.to_int())
+    elif isinstance(docs1, Bitmap):
+        data = bytearray(docs1.data)
+        for doc in docs2:
+            byte_no = (doc >> 3) - docs1.base
+            if 0 <= byte_no < len(data):
+                data[byte_no] &= ~(1 << (doc & 7))
+        return Bitmap(data, base = docs1.base)
+    else:
+        return [doc for doc in docs1 if doc not in docs2]
+
+class Bitmap:
+    """A sorted document posting kept as a bitmap, bit d set for document d.
+
+    The bytes start at the byte number base, the bitmaps of the segments far
+    from document 0 are not padded. Merging two bitmaps is done on whole
+    Python integers, a word at a time, and a document is checked with a
+    single byte lookup."""
+    def __init__(self, data, count = None, base = 0):
+        self.data = data
+        self.count = count
+        self.base = base
+
+    @staticmethod
+    def from_int(bits):
+        '''Creates a bitmap from the bits of an integer, without the empty
+        bytes before its first document'''
+        base = ((bits & -bits).bit_length() - 1) >> 3 if bits else 0
+        bits >>= base << 3
+        return Bitmap(bits.to_bytes((bits.bit_length() + 7) // 8, 'little'), base = base)
+
+    def to_int(self):
+        '''Returns the bits of the bitmap as an integer'''
+        return int.from_bytes(self.data, 'little') << (self.base << 3)
+
+    def complement(self, document_count):
+        '''Returns the bitmap of the documents from 1 to document_count not
+        in this one'''
+        universe = (1 << (document_count + 1)) - 2
+        return Bitmap.from_int(universe & ~self.to_int())
+
+    def __len__(self):
+        if self.count is None:
+            self.count = int.from_bytes(self.data, 'little').bit_count()
+        return self.count
+
+    def __contains__(self, doc):
+        byte_no = (doc >> 3) - self.base
+        return 0 <= byte_no < len(self.data) and self.data[byte_no] >> (doc & 7) & 1
+
+    def __iter__(self):
+        return iter(codec.decode_bitmap(self.data, self.base))
+
+    def cursor(self):
+        '''Returns a cursor jumping over the empty bytes of the bitmap'''
+        return BitmapCursor(self.data, self.base)
+
+class Complement:
+    """The documents from 1 to document_count missing from a sorted posting.
+
+    The complement is kept symbolic: its length is computed from the excluded
+    documents and it is iterated as a chain of ranges between them, so the
+    document universe is never walked in a Python loop."""
+    def __init__(self, excluded, document_count):
+        if not isinstance(excluded, (list, array.array)):
+            excluded = list(excluded)
+        self.excluded = excluded
+        self.document_count = document_count
+
+    def __len__(self):
+        return self.document_count - (bisect.bisect_right(self.excluded,
+            self.document_count) - bisect.bisect_left(self.excluded, 1))
+
+    def ranges(self):
+        '''Generator for the ranges of documents between the excluded ones'''
+        start = 1
+        for doc in self.excluded:
+            if doc > self.document_count:
+                break
+            if doc > start:
+                yield range(start, doc)
+            start = max(start, doc + 1)
+        if start <= self.document_count:
+            yield range(start, self.document_count + 1)
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.ranges())
+
+    def cursor(self):
+        '''Returns a cursor skipping the excluded documents'''
+        return ComplementCursor(self.excluded, self.document_count)
+
+class ListCursor:
+    '''Cursor galloping over a plain sorted list'''
+    def __init__(self, docs):
+        self.docs = docs
+        self.pos = 0
+
+    def next_geq(self, target):
+        '''Moves to the first document >= target and returns it or None'''
+        docs = self.docs
+        low = self.pos
+        if low >= len(docs):
+            return None
+        if docs[low] >= target:
+            return docs[low]
+
+        step = 1
+        high = low + 1
+        while high < len(docs) and docs[high] < target:
+            low = high
+            step *= 2
+            high = low + step
+        self.pos = bisect.bisect_left(docs, target, low, min(high, len(docs)))
+        if self.pos < len(docs):
+            return docs[self.pos]
+        return None
+
+    def skip_run(self):
+        """Moves past the run of consecutive documents starting at the current
+        one and returns the document following the run.
+
+        In a run docs[i] - i is constant, so its end is found galloping like
+        in next_geq instead of stepping over the documents one by one."""
+        docs = self.docs
+        low = self.pos
+        shift = docs[low] - low
+        step = 1
+        high = low + 1
+        while high < len(docs) and docs[high] - high == shift:
+            low = high
+            step *= 2
+            high = low + step
+        high = min(high, len(docs))
+        while high - low > 1:
+            middle = (low + high) // 2
+            if docs[middle] - middle == shift:
+                low = middle
+            else:
+                high = middle
+        self.pos = high
+        return docs[low] + 1
+
+class BlockCursor:
+    '''Cursor over a block coded posting decoding only the needed blocks'''
+    def __init__(self, buf, offset = 0, on_decode = None):
+        self.buf = buf
+        self.offset = offset
+        self.on_decode = on_decode
+        self.lasts, self.starts = codec.block_table(buf, offset)
+        self.block_no = -1
+        self.block = []
+        self.pos = 0
+
+    def load_block(self, block_no):
+        '''Decodes a single block of the posting'''
+        self.block = codec.decode_block(self.buf, block_no, self.lasts,
+                self.starts, offset = self.offset)
+        self.block_no = block_no
+        self.pos = 0
+        if self.on_decode is not None:
+            self.on_decode(codec.block_size(self.buf, block_no, self.starts,
+                self.offset), 4 * len(self.block))
+
+    def next_geq(self, target):
+        '''Moves to the first document >= target and returns it or None'''
+        block_no = max(self.block_no, 0)
+        if block_no >= len(self.lasts):
+            return None
+        if self.lasts[block_no] < target:
+            block_no = bisect.bisect_left(self.lasts, target, block_no)
+            if block_no >= len(self.lasts):
+                self.block_no = block_no
+                return None
+        if block_no != self.block_no:
+            self.load_block(block_no)
+
+        self.pos = bisect.bisect_left(self.block, target, self.pos)
+        return self.block[self.pos]
+
+class IterCursor:
+    '''Cursor stepping linearly over any sorted iterable'''
+    def __init__(self, docs):
+        self.iter = iter(docs)
+        self.current = None
+        self.exhausted = False
+
+    def next_geq(self, target):
+        '''Moves to the first document >= target and returns it or None'''
+        if self.exhausted:
+            return None
+        try:
+            while self.current is None or self.current < target:
+                self.current = next(self.iter)
+        except StopIteration:
+            self.exhausted = True
+            return None
+        return self.current
+
+class BitmapCursor:
+    '''Cursor over a bitmap finding the next set bit'''
+    def __init__(self, data, base = 0):
+        self.data = data
+        self.base = base
+
+    def next_geq(self, target):
+        '''Moves to the first document >= target and returns it or None'''
+        target = max(target, self.base << 3)
+        byte_no = (target >> 3) - self.base
+        if byte_no >= len(self.data):
+            return None
+        bits = codec.BITS[self.data[byte_no] >> (target & 7) << (target & 7)]
+        if bits != ():
+            return ((byte_no + self.base) << 3) + bits[0]
+        nonzero = NONZERO.search(self.data, byte_no + 1)
+        if nonzero is None:
+            return None
+        byte_no = nonzero.start()
+        return ((byte_no + self.base) << 3) + codec.BITS[self.data[byte_no]][0]
+
+class ComplementCursor:
+    '''Cursor over a complement galloping over the excluded documents'''
+    def __init__(self, excluded, document_count):
+        self.excluded = ListCursor(excluded)
+        self.document_count = document_count
+        self.doc = 1
+
+    def next_geq(self, target):
+        '''Moves to the first document >= target and returns it or None'''
+        target = max(target, self.doc)
+        if self.excluded.next_geq(target) == target:
+            target = self.excluded.skip_run()
+        self.doc = target
+        if target > self.document_count:
+            return None
+        return target
+
+class PostingTest(unittest.TestCase):
+    def setUp(self):
+        self.docs = list(range(3, 1000, 7))
+        self.blocked = BlockPosting(codec.encode(self.docs))
+
+    def test_iteration(self):
+        self.assertEqual(list(self.blocked), self.docs)
+        self.assertEqual(len(self.blocked), len(self.docs))
+
+    def test_cursors(self):
+        for cur in [self.blocked.cursor(), ListCursor(self.docs), IterCursor(self.docs)]:
+            self.assertEqual(cur.next_geq(0), 3)
+            self.assertEqual(cur.next_geq(4), 10)
+            self.assertEqual(cur.next_geq(10), 10)
+            self.assertEqual(cur.next_geq(500), 500)
+            self.assertEqual(cur.next_geq(995), 997)
+            self.assertEqual(cur.next_geq(998), None)
+
+    def test_block_decode_sizes(self):
+        sizes = []
+        blocked = BlockPosting(self.blocked.buf, on_decode = lambda read, decoded:
+                sizes.append((read, decoded)))
+        self.assertEqual(blocked.cursor().next_geq(990), 990)
+        self.assertEqual(len(sizes), 1)
+        self.assertEqual(sizes[0][1], 4 * (len(self.docs) % codec.BLOCK_SIZE))
+        list(blocked)
+        self.assertEqual(sizes[1], (len(self.blocked.buf) -
+            codec.table_size(self.blocked.buf), 4 * len(self.docs)))
+
+    def test_complement(self):
+        complement = Complement(iter([1, 2, 5, 6, 9, 12]), 10)
+        self.assertEqual(len(complement), 5)
+        self.assertEqual(list(complement), [3, 4, 7, 8, 10])
+        cur = complement.cursor()
+        self.assertEqual(cur.next_geq(0), 3)
+        self.assertEqual(cur.next_geq(5), 7)
+        self.assertEqual(cur.next_geq(9), 10)
+        self.assertEqual(cur.next_geq(11), None)
+        self.assertEqual(list(Complement([], 3)), [1, 2, 3])
+        cur = Complement([2, 3, 4, 6, 7, 9], 10).cursor()
+        self.assertEqual([cur.next_geq(doc) for doc in [2, 6, 6, 8, 9, 11]],
+                [5, 8, 8, 8, 10, None])
+        cur = Complement(list(range(1, 10 ** 6)) + [10 ** 6 + 1], 10 ** 6 + 2).cursor()
+        self.assertEqual(cur.next_geq(0), 10 ** 6)
+        self.assertEqual(cur.next_geq(10 ** 6 + 1), 10 ** 6 + 2)
+        self.assertEqual(cur.next_geq(10 ** 6 + 3), None)
+        self.assertEqual(len(Complement(range(1, 4), 3)), 0)
+
+    def test_bitmap(self):
+        bitmap = to_bitmap(self.docs)
+        self.assertEqual(list(bitmap), self.docs)
+        self.assertEqual(len(Bitmap(bitmap.data)), len(self.docs))
+        self.assertTrue(500 in bitmap)
+        self.assertFalse(501 in bitmap)
+        self.assertFalse(5000 in bitmap)
+        cur = bitmap.cursor()
+        self.assertEqual(cur.next_geq(0), 3)
+        self.assertEqual(cur.next_geq(4), 10)
+        self.assertEqual(cur.next_geq(995), 997)
+        self.assertEqual(cur.next_geq(998), None)
+        self.assertEqual(list(bitmap.complement(12)), [1, 2, 4, 5, 6, 7, 8, 9, 11, 12])
+
+    def test_bitmap_base(self):
+        docs = [80001, 80003, 80100]
+        bitmap = to_bitmap(docs)
+        self.assertEqual((bitmap.base, len(bitmap.data)), (10000, 13))
+        self.assertEqual(list(bitmap), docs)
+        self.assertTrue(80003 in bitmap)
+        self.assertFalse(3 in bitmap)
+        cur = bitmap.cursor()
+        self.assertEqual([cur.next_geq(doc) for doc in [0, 80002, 80004, 80101]],
+                [80001, 80003, 80100, None])
+        self.assertEqual(list(union(bitmap, [5, 80002])), [5, 80001, 80002, 80003, 80100])
+        self.assertEqual(list(union(bitmap, to_bitmap([7]))), [7] + docs)
+        self.assertEqual(union(bitmap, to_bitmap([80002])).base, 10000)
+        self.assertEqual(list(intersection(bitmap, [3, 80003])), [80003])
+        self.assertEqual(list(difference(bitmap, [3, 80003])), [80001, 80100])
+        self.assertEqual(list(difference(to_bitmap(range(79990, 80010)), bitmap)),
+                [doc for doc in range(79990, 80010) if doc not in docs])
+        self.assertEqual(list(bitmap.complement(80002)), list(range(1, 80001)) + [80002])
+
+    def test_bitmap_kernels(self):
+        others = [1, 10, 17, 18, 2000]
+        for docs1, docs2 in [(to_bitmap(self.docs), others),
+                (self.docs, to_bitmap(others)), (to_bitmap(self.docs), to_bitmap(others))]:
+            self.assertEqual(list(union(docs1, docs2)), sorted(set(self.docs) | set(others)))
+            self.assertEqual(list(intersection(docs1, docs2)), [10, 17])
+            self.assertEqual(list(difference(docs1, docs2)), sorted(set(self.docs) - set(others)))
+            self.assertEqual(list(difference(docs2, docs1)), [1, 18, 2000])
+
+    def test_union_all(self):
+        others = [1, 10, 17, 18, 2000]
+        expected = sorted(set(self.docs) | set(others) | {5})
+        self.assertEqual(list(union_all([self.docs, others, [5, 10]])), expected)
+        self.assertEqual(list(union_all([to_bitmap(self.docs), others, to_bitmap([5, 10])])),
+                expected)
+        self.assertEqual(union_all([self.docs]), self.docs)
+        self.assertEqual(list(union_all([])), [])
+
+    def test_empty(self):
+        self.assertEqual(Posting([]).cursor().next_geq(1), None)
+        self.assertEqual(to_bitmap([]).cursor().next_geq(1), None)
+        self.assertEqual(BlockPosting(codec.encode([])).cursor().next_geq(1), None)
+
+if __name__ == "__main__":
+    unittest.main()
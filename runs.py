@@ -0,0 +1,54 @@
+#!/usr/bin/python3.1 -OO
+'''File for the sorted binary runs of the in-memory inversion and tests for it'''
+import unittest
+import array
+import os
+import struct
+import tempfile
+import codec
+
+RECORD_HEADER = struct.Struct('<HI')
+
+def write_run(filename, postings):
+    """Writes a run of term postings sorted by the UTF-8 encoded terms.
+
+    The postings map terms to flat arrays of (document, position) pairs,
+    every record is the term length, the array length, the term and the
+    array."""
+    terms = sorted((term.encode('utf-8'), term) for term in postings)
+    with open(filename, 'wb') as handle:
+        for key, term in terms:
+            pairs = postings[term]
+            handle.write(RECORD_HEADER.pack(len(key), len(pairs)))
+            handle.write(key)
+            handle.write(codec.to_little_endian(pairs).tobytes())
+
+def read_run(filename):
+    '''Generator for the (encoded term, pairs array) records of a run'''
+    with open(filename, 'rb') as handle:
+        while True:
+            header = handle.read(RECORD_HEADER.size)
+            if not header:
+                break
+            key_length, length = RECORD_HEADER.unpack(header)
+            key = handle.read(key_length)
+            pairs = array.array(codec.UINT32)
+            pairs.frombytes(handle.read(4 * length))
+            yield key, codec.to_little_endian(pairs)
+
+class RunTest(unittest.TestCase):
+    def test_roundtrip(self):
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        postings = {'żubr': array.array(codec.UINT32, [1, 2]),
+                'kot': array.array(codec.UINT32, [1, 1, 3, 5])}
+        try:
+            write_run(filename, postings)
+            records = [(key, list(pairs)) for key, pairs in read_run(filename)]
+        finally:
+            os.remove(filename)
+        self.assertEqual(records, [(b'kot', [1, 1, 3, 5]),
+            ('żubr'.encode('utf-8'), [1, 2])])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,18 @@
 #!/usr/bin/python3.1 -OO
 '''File for the Searcher class and tests for it'''
 import unittest
+import array
+import heapq
 import itertools
+import operator
 import re
+import shutil
+import tempfile
+import cache
+import codec
+import indexer
+import posting
+import vectorized
 
 class EmptyQuery(Exception):
     '''Exception for empty query'''
@@ -34,11 +44,13 @@ class Query:
     def parse_cnf(self, query_str):
         '''Parses the query as a cnf'''
         self.type = "cnf"
-        illegal_char_regexp = re.compile(r'[^0-9a-zęóąśłżźćń~]')
+        illegal_char_regexp = re.compile(r'[^0-9a-zęóąśłżźćń~*]')
 
         self.clauses = [clause.split('|') for clause in query_str.split(' ') if clause != '']
         for clause in self.clauses:
             filter(lambda word: not illegal_char_regexp.search(word), clause)
+        if self.clauses == [] or any('' in clause for clause in self.clauses):
+            raise EmptyQuery()
 
     def get_words(self):
         '''Generator for the words in queries'''
@@ -62,129 +74,322 @@ class Query:
         elif self.type == 'phrase':
             return '"' + ' '.join(self.terms) + '"'
 
+def wildcard_prefix(word):
+    '''Returns the prefix of a wildcard word (foo* matches the terms starting
+    with foo), None for other words'''
+    if word[-1:] == '*':
+        return word[:-1]
+    return None
+
 class SearchResult:
     def __init__(self, docs = {}, negation = False):
         self.docs = docs
         self.negation = negation
 
+def compact(docs):
+    '''Returns the documents as a bitmap or an array of document numbers'''
+    if isinstance(docs, posting.Bitmap):
+        # a bitmap read from the index is a view of a mapped partition
+        return posting.Bitmap(bytearray(docs.data), len(docs), docs.base)
+    return array.array(codec.UINT32, docs)
+
+def materialized(docs):
+    '''Checks whether a document list is already kept whole in memory'''
+    if isinstance(docs, (list, array.array, posting.Bitmap)):
+        return True
+    return vectorized.numpy is not None and isinstance(docs, vectorized.numpy.ndarray)
+
+def result_size(result):
+    '''Approximate memory taken by a cached search result'''
+    if isinstance(result.docs, posting.Bitmap):
+        return 64 + len(result.docs.data)
+    return 64 + result.docs.itemsize * len(result.docs)
+
 class Searcher:
-    def __init__(self, indexer):
+    def __init__(self, indexer, result_cache_size = 32 * 2**20, backend = 'python',
+            max_expansions = 1000):
+        if backend not in ('python', 'numpy'):
+            raise Exception("Unknown search backend %(backend)s" % {'backend': backend})
+        elif backend == 'numpy' and vectorized.numpy is None:
+            raise Exception("The numpy search backend needs NumPy installed")
         self.indexer = indexer
-
-    def search(self, query):
-        if query.type == "cnf":
-            results = self.search_cnf(query)
-            if results.negation:
-                docs = self.subtract_from_uni(self.indexer.document_count,
-                        results.docs)
+        # the NumPy kernels take the place of the generators merging the lists
+        self.vectorized = backend == 'numpy'
+        # a wildcard matches at most this many first terms of the index
+        self.max_expansions = max_expansions
+        self.results = cache.LRUCache(result_cache_size, result_size)
+        self.results_version = None
+        # the number of uses of the terms and the clauses in the current batch
+        # and the results of the ones used more than once
+        self.batch_uses = {}
+        self.batch_results = {}
+
+    def check_version(self):
+        '''Drops the cached results if the index changed since they were computed'''
+        if self.indexer.segments_version != self.results_version:
+            self.results.clear()
+            self.results_version = self.indexer.segments_version
+
+    def query_key(self, query):
+        """Returns the canonical form of a query.
+
+        The words are replaced by their sorted bases and the terms and the
+        clauses are sorted, so equivalent queries share the key."""
+        if query.type == "phrase":
+            return ("phrase", tuple(self.word_key(term) for term in query.terms))
+        return ("cnf", tuple(sorted(set(self.clause_key(clause)
+            for clause in query.clauses))))
+
+    def word_key(self, word):
+        '''Returns the sorted bases of a word, the wildcard words are kept as they are'''
+        if wildcard_prefix(word) is not None:
+            return (word,)
+        return tuple(sorted(set(self.indexer.normalize(word))))
+
+    def forms(self, word):
+        '''Returns the index terms of a word, its bases or the expansion of a wildcard'''
+        prefix = wildcard_prefix(word)
+        if prefix is None:
+            return self.indexer.normalize(word)
+        return self.indexer.expand_prefix(prefix, self.max_expansions)
+
+    def clause_key(self, clause):
+        '''Returns the canonical form of a clause, the sorted (negation, bases) terms'''
+        return tuple(sorted(set((True, self.word_key(term[1:])) if term[0] == '~'
+            else (False, self.word_key(term)) for term in clause)))
+
+    def cached(self, query):
+        '''Checks whether the result of a query is in the result cache'''
+        self.check_version()
+        return self.query_key(query) in self.results
+
+    def search(self, query, limit = None):
+        """Searches for a query, going through the result cache.
+
+        The results are kept compact (negated ones as the excluded documents)
+        and keyed by the canonical form of the query. With a limit given only
+        a page of the result is wanted, so a result that is still computed
+        lazily is returned as it is and not cached."""
+        self.check_version()
+        key = self.query_key(query)
+        results = self.results.get(key)
+        if results is None:
+            if query.type == "cnf":
+                results = self.search_cnf(query)
             else:
-                docs = results.docs
+                results = SearchResult(self.search_phrase(query), False)
+            if limit is None or results.negation or materialized(results.docs):
+                results = SearchResult(compact(results.docs), results.negation)
+                self.results[key] = results
+
+        if (results.negation and isinstance(results.docs, posting.Bitmap) and
+                16 * len(results.docs.data) >= self.indexer.document_count):
+            # the bitmap spans about the whole universe, negate it at once
+            docs = results.docs.complement(self.indexer.document_count)
+            if self.indexer.deleted != []:
+                docs = posting.difference(docs, self.indexer.deleted)
+        elif results.negation:
+            excluded = results.docs
+            if self.indexer.deleted != []:
+                excluded = self.merge_or_docs(excluded, self.indexer.deleted)
+            docs = posting.Complement(excluded, self.indexer.document_count)
         else:
-            docs = self.search_phrase(query)
+            docs = results.docs
 
         return docs
 
-    def search_phrase(self, query):
-        posting = []
-        for term in query.terms:
-            bases = self.indexer.normalize(term)
-            base_postings = [self.indexer.get_positional_posting(base) for base in bases] 
-            res = base_postings[0]
-            for p in base_postings[1:]:
-                res = self.merge_phrase_bases(res, p)
-
-            posting.append(res)
-
-        res = posting[0]
-        for p in posting[1:]:
-            res = self.merge_phrase(res, p)
-        for doc, pos in res:
-            yield doc
-
-    def merge_phrase_bases(self, base1, base2):
-        res = []
-        iter1 = iter(base1)
-        iter2 = iter(base2)
-
+    def search_batch(self, queries):
+        '''Searches for a batch of queries, evaluating the terms and the clauses
+        shared by several queries only once'''
+        self.begin_batch(queries)
         try:
-            last = (1, None)
-            e1 = next(iter1)
-            last = (2, e1)
-            e2 = next(iter2)
-            while True:
-                if e1[0] < e2[0]:
-                    yield e1
-                    last = (1, e2)
-                    e1 = next(iter1)
-                elif e1[0] > e2[0]:
-                    yield e2
-                    last = (2, e1)
-                    e2 = next(iter2)
-                else:
-                    yield e1[0], list(self.merge_or_docs(e1[1], e2[1]))
-                    last = (1, None)
-                    e1 = next(iter1)
-                    last = (2, e1)
-                    e2 = next(iter2)
-        except StopIteration:
-            if last[1]:
-                yield last[1]
-            if last[0] == 1:
-                for e in iter2:
-                    yield e
-            elif last[0] == 2:
-                for e in iter1:
-                    yield e
-
-    def merge_phrase(self, docs1, docs2):
+            return [self.search(query) for query in queries]
+        finally:
+            self.end_batch()
+
+    def begin_batch(self, queries):
+        """Prepares the evaluation of a batch of queries.
+
+        The uses of the canonical terms and clauses are counted over the whole
+        batch, the results of the repeated ones are materialized when first
+        needed and reused until end_batch is called."""
+        uses = {}
+        for query in queries:
+            if query.type == "cnf":
+                for clause in set(self.clause_key(clause) for clause in query.clauses):
+                    uses[('clause', clause)] = uses.get(('clause', clause), 0) + 1
+                    if uses[('clause', clause)] == 1:
+                        for _, bases in clause:
+                            uses[('term', bases)] = uses.get(('term', bases), 0) + 1
+        self.batch_uses = uses
+
+    def end_batch(self):
+        '''Forgets the results shared in a batch'''
+        self.batch_uses = {}
+        self.batch_results = {}
+
+    def shared_result(self, key, compute):
+        '''Returns a copy of the result of compute, evaluated once per batch if
+        the key is used more than once in the batch'''
+        if self.batch_uses.get(key, 0) < 2:
+            return compute()
+        if key not in self.batch_results:
+            results = compute()
+            self.batch_results[key] = SearchResult(self.materialize(results.docs),
+                    results.negation)
+        results = self.batch_results[key]
+        return SearchResult(results.docs, results.negation)
+
+    def count(self, query):
+        '''Counts the documents matching a query, a negated result is counted
+        without enumerating the documents'''
+        return Searcher.total(self.search(query))
+
+    @staticmethod
+    def total(docs):
+        '''Counts the documents of a search result'''
+        count = posting.length(docs)
+        if count == float('inf'):
+            count = sum(1 for _ in docs)
+        return count
+
+    @staticmethod
+    def page(docs, offset = 0, limit = None):
+        '''Returns at most limit documents of a search result starting from the
+        offset one, the result is iterated only as far as needed'''
+        if limit is None:
+            return list(itertools.islice(docs, offset, None))
+        return list(itertools.islice(docs, offset, offset + limit))
+
+    @staticmethod
+    def total_page(docs, offset = 0, limit = None):
+        '''Returns the count of the documents of a search result and their page,
+        a lazy result is iterated once and only the page is kept'''
+        if posting.length(docs) != float('inf'):
+            return Searcher.total(docs), Searcher.page(docs, offset, limit)
+        docs = iter(docs)
+        skipped = sum(1 for _ in itertools.islice(docs, offset))
+        page = list(itertools.islice(docs, limit))
+        return skipped + len(page) + sum(1 for _ in docs), page
+
+    def search_phrase(self, query):
+        """Generator for the documents containing a phrase.
+
+        Adjacent terms are looked up together in the biword index when every
+        pair of their bases has a frequent base (so it was indexed), the other
+        terms use their positional postings. The pieces are then merged by
+        their distance in the phrase."""
+        bases = [list(self.indexer.normalize(term)) for term in query.terms]
+        frequent = self.indexer.get_frequent()
+        covered = [all(first in frequent or second in frequent
+            for first in bases[i] for second in bases[i + 1])
+            for i in range(len(bases) - 1)]
+
+        pieces = []
+        for i in range(len(bases)):
+            if i < len(covered) and covered[i]:
+                pieces.append((i, self.phrase_alternatives(
+                    [self.indexer.get_positional_posting(first + ' ' + second)
+                    for first in bases[i] for second in bases[i + 1]])))
+            elif i == 0 or not covered[i - 1]:
+                pieces.append((i, self.phrase_alternatives(
+                    [self.indexer.get_positional_posting(base) for base in bases[i]])))
+
+        offsets = [i for i, _ in pieces]
+        for doc, positions in self.merge_phrase_documents([p for _, p in pieces]):
+            if self.match_phrase(offsets, positions):
+                yield doc
+
+    def phrase_alternatives(self, postings):
+        '''Generator for the (document, position lists) of the alternatives of a
+        term, their postings are merged with a heap and the lists are not copied'''
+        merged = heapq.merge(*postings, key = operator.itemgetter(0))
+        for doc, group in itertools.groupby(merged, operator.itemgetter(0)):
+            yield doc, [positions for _, positions in group]
+
+    def merge_phrase_documents(self, streams):
+        '''Generator for the documents present in all the streams, together with
+        the position lists of every stream'''
+        iters = [iter(stream) for stream in streams]
         try:
-            iter1 = iter(docs1)
-            iter2 = iter(docs2)
-            d1, k1 = next(iter1)
-            d2, k2 = next(iter2)
+            heads = [next(it) for it in iters]
             while True:
-                if d1 < d2:
-                    d1, k1 = next(iter1)
-                elif d2 < d1:
-                    d2, k2 = next(iter2)
-                else:
-                    positions = []
-                    try:
-                        pos_iter1 = iter(k1)
-                        pos_iter2 = iter(k2)
-                        pos1 = next(pos_iter1)
-                        pos2 = next(pos_iter2)
-                        while True:
-                            if pos1 + 1 < pos2:
-                                pos1 = next(pos_iter1)
-                            elif pos1 + 1 > pos2:
-                                pos2 = next(pos_iter2)
-                            else:
-                                positions.append(pos2)
-                                pos1 = next(pos_iter1)
-                                pos2 = next(pos_iter2)
-                    except StopIteration:
-                        if positions != []:
-                            yield [d1, positions]
-                        d1, k1 = next(iter1)
-                        d2, k2 = next(iter2)
+                doc = max(head[0] for head in heads)
+                for k, it in enumerate(iters):
+                    while heads[k][0] < doc:
+                        heads[k] = next(it)
+                if all(head[0] == doc for head in heads):
+                    yield doc, [head[1] for head in heads]
+                    heads = [next(it) for it in iters]
         except StopIteration:
             pass
 
+    def match_phrase(self, offsets, positions):
+        """Checks whether the pieces of a phrase occur at their offsets in a document.
+
+        Every piece is a union of galloping cursors over the position lists of
+        its alternatives. The candidate start of the phrase only grows, so the
+        scan stops at the first match or when any piece runs out."""
+        if self.vectorized:
+            return vectorized.match_phrase(offsets, positions)
+        pieces = [(offset, [posting.ListCursor(p) for p in lists])
+                for offset, lists in zip(offsets, positions)]
+        start = 0
+        matched = 0
+        k = 0
+        while matched < len(pieces):
+            offset, cursors = pieces[k]
+            found = [p for p in (c.next_geq(start + offset) for c in cursors)
+                    if p is not None]
+            if found == []:
+                return False
+            position = min(found)
+            if position == start + offset:
+                matched += 1
+            else:
+                start = position - offset
+                matched = 1
+            k = (k + 1) % len(pieces)
+        return True
+
     def search_cnf(self, query):
-        to_list = lambda res: SearchResult(res.docs, res.negation)
-        clause_results = (to_list(self.search_clause(clause))
-                for clause in query.clauses)
+        clauses = sorted(query.clauses, key = self.estimate_clause)
+
+        results = self.search_clause(clauses[0])
+        for clause in clauses[1:]:
+            if not results.negation and posting.length(results.docs) == 0:
+                break
+            results = self.merge_and(results, self.search_clause(clause))
+            results.docs = self.materialize(results.docs)
+        return results
 
-        # sort by result length
-        #clause_results.sort(key = lambda x: len(x.docs))
+    def estimate_clause(self, clause):
+        '''Estimates the number of documents matching a clause'''
+        return min(sum(self.estimate_term(term) for term in clause),
+                self.indexer.document_count)
+
+    def estimate_term(self, term):
+        '''Estimates the number of documents matching a term'''
+        if term[0] == '~':
+            word = term[1:]
+        else:
+            word = term
+
+        count = min(sum(self.indexer.get_df(form) for form in self.forms(word)),
+                self.indexer.document_count)
+        if term[0] == '~':
+            return self.indexer.document_count - count
+        else:
+            return count
 
-        results = next(clause_results)
-        for clause_result in clause_results:
-            results = self.merge_and(results, clause_result)
-        return results
-      
     def search_clause(self, clause):
+        if self.batch_uses:
+            return self.shared_result(('clause', self.clause_key(clause)),
+                    lambda: self.merge_clause(clause))
+        return self.merge_clause(clause)
+
+    def merge_clause(self, clause):
+        '''Or-merges the results of the terms of a clause'''
         term_results = (self.search_term(term) for term in clause)
         results = next(term_results)
         for term_result in term_results:
@@ -199,15 +404,20 @@ class Searcher:
             neg = False
             word = term
 
-        postings = [SearchResult(self.indexer.get_posting(form), False)
-            for form in self.indexer.normalize(word)]   
-       
-        res = postings[0]
-        for pos in postings[1:]:
-            res = self.merge_or(res, pos)
+        if self.batch_uses:
+            res = self.shared_result(('term', self.word_key(word)),
+                    lambda: self.search_word(word))
+        else:
+            res = self.search_word(word)
         res.negation = neg
         return res
 
+    def search_word(self, word):
+        '''Or-merges at once the postings of the bases of a word or of the
+        terms matching a wildcard'''
+        return SearchResult(self.merge_or_all([self.indexer.get_posting(form)
+            for form in self.forms(word)]), False)
+
     def merge_or(self, res1, res2):
         """Merges with OR two search results in O(m + n) time."""
         if res1.negation and res2.negation:
@@ -226,7 +436,27 @@ class Searcher:
             # x | y
             return SearchResult(self.merge_or_docs(res2.docs, res1.docs), False)
 
+    def materialize(self, docs):
+        '''Returns a document list that can be iterated many times'''
+        if self.vectorized:
+            return vectorized.to_array(docs)
+        return posting.materialize(docs)
+
     def merge_or_docs(self, docs1, docs2):
+        '''Or-merges lists, word-parallel when there are bitmaps'''
+        if self.vectorized:
+            return vectorized.union(docs1, docs2)
+        if isinstance(docs1, posting.Bitmap) or isinstance(docs2, posting.Bitmap):
+            return posting.union(docs1, docs2)
+        return self.merge_or_lists(docs1, docs2)
+
+    def merge_or_all(self, doc_lists):
+        '''Or-merges any number of lists with a single n-way union'''
+        if self.vectorized:
+            return vectorized.union_all(doc_lists)
+        return posting.union_all(doc_lists)
+
+    def merge_or_lists(self, docs1, docs2):
         '''Generator for or-merging lists'''
         gen1 = iter(docs1)
         gen2 = iter(docs2)
@@ -271,7 +501,7 @@ class Searcher:
             yield(elem2)
 
     def merge_and(self, res1, res2):
-        """Merges with AND two search results in O(m + n) time."""
+        """Merges with AND two search results in O(m log n) time."""
         if res1.negation and res2.negation:
             # ~x & ~y  <=>  ~(x | y)
             res1.negation = res2.negation = False
@@ -289,53 +519,44 @@ class Searcher:
             return SearchResult(self.merge_and_docs(res1.docs, res2.docs), False)
 
     def merge_and_docs(self, docs1, docs2):
-        '''Generator for and-merging lists'''
-        gen1 = iter(docs1)
-        gen2 = iter(docs2)
-        try:
-            elem1 = next(gen1)
-            elem2 = next(gen2)
-            while True:
-                if elem1 < elem2:
-                    elem1 = next(gen1)
-                elif elem1 > elem2:
-                    elem2 = next(gen2)
-                else:
-                    yield(elem1)
-                    elem1 = next(gen1)
-                    elem2 = next(gen2)
-        except StopIteration:
-            pass
-
-    def subtract_from_uni(self, document_count, docs):
-        '''Generator for subtracting a posting from the universe'''
-        start = 1
-        for n in docs:
-            for i in range(start, n):
-                yield(i)
-            start = n+1
-        for i in range(start, document_count+1):
-            yield(i)
+        '''And-merges lists, word-parallel when there are bitmaps'''
+        if self.vectorized:
+            return vectorized.intersection(docs1, docs2)
+        if isinstance(docs1, posting.Bitmap) or isinstance(docs2, posting.Bitmap):
+            return posting.intersection(docs1, docs2)
+        return self.merge_and_lists(docs1, docs2)
+
+    def merge_and_lists(self, docs1, docs2):
+        '''Generator for and-merging lists, galloping over the skip entries'''
+        if posting.length(docs1) > posting.length(docs2):
+            docs1, docs2 = docs2, docs1
+        cur1 = posting.cursor(docs1)
+        cur2 = posting.cursor(docs2)
+        elem1 = cur1.next_geq(0)
+        while elem1 is not None:
+            elem2 = cur2.next_geq(elem1)
+            if elem2 is None:
+                break
+            if elem1 == elem2:
+                yield(elem1)
+                elem1 = cur1.next_geq(elem1 + 1)
+            else:
+                elem1 = cur1.next_geq(elem2)
 
     def subtract(self, docs1, docs2):
-        """Generator for subtracting two lists in O(m + n) time."""
+        '''Subtracts lists, word-parallel when there are bitmaps'''
+        if self.vectorized:
+            return vectorized.difference(docs1, docs2)
+        if isinstance(docs1, posting.Bitmap) or isinstance(docs2, posting.Bitmap):
+            return posting.difference(docs1, docs2)
+        return self.subtract_lists(docs1, docs2)
+
+    def subtract_lists(self, docs1, docs2):
+        """Generator for subtracting two lists in O(m log n) time."""
         # x \ y
-        gen1 = iter(docs1)
-        gen2 = iter(docs2)
-        try:
-            elem2 = next(gen2)
-            elem1 = next(gen1)
-            while True:
-                if elem1 < elem2:
-                    yield(elem1)
-                    elem1 = next(gen1)
-                elif elem1 > elem2:
-                    elem2 = next(gen2)
-                else:
-                    elem2 = next(gen2)
-                    elem1 = next(gen1)
-        except StopIteration:
-            for elem1 in gen1:
+        cur2 = posting.cursor(docs2)
+        for elem1 in docs1:
+            if cur2.next_geq(elem1) != elem1:
                 yield elem1
 
 
@@ -372,6 +593,12 @@ class QueryTest(unittest.TestCase):
         self.assertEqual(q.terms, ['foo', 'bar'])
         self.assertEqual(q.type, 'phrase')
 
+    def test_wildcard(self):
+        q = Query("kot* ~pies*|foo")
+        self.assertEqual(list(q.clauses), [['kot*'], ['~pies*', 'foo']])
+        self.assertEqual(wildcard_prefix('kot*'), 'kot')
+        self.assertEqual(wildcard_prefix('kot'), None)
+
     def test_empty_query(self):
         q = Query()
         self.assertEqual(q.type, "")
@@ -380,27 +607,48 @@ class QueryTest(unittest.TestCase):
         q = Query()
         self.assertRaises(EmptyQuery, q.parse, '""')
 
+    def test_empty_term(self):
+        self.assertRaises(EmptyQuery, Query, 'a|')
+        self.assertRaises(EmptyQuery, Query, 'foo |bar')
+        self.assertRaises(EmptyQuery, Query, '  ')
+        self.assertEqual(Query('~').clauses, [['~']])
+
+def mock_index(test):
+    '''Returns an index of ten documents over the test.docs postings, the
+    terms fetched from it are appended to test.fetched'''
+    test.docs = {
+                'foo' : [1, 2, 3, 4, 5],
+                'bar' : [2, 3, 7, 8, 9],
+                'baz' : [1, 2, 7],
+                'alone' : [6, 10]
+            }
+    test.fetched = []
+
+    class IndexerMock:
+        document_count = 10
+        deleted = []
+        segments_version = None
+        def get_title(self, doc):
+            return doc
+
+        def get_posting(self, term):
+            test.fetched.append(term)
+            return test.docs[term]
+
+        def get_df(self, term):
+            return len(test.docs[term])
+
+        def normalize(self, term):
+            return [term]
+
+        def expand_prefix(self, prefix, limit = None):
+            return sorted(term for term in test.docs if term.startswith(prefix))[:limit]
+
+    return IndexerMock()
+
 class SearcherTest(unittest.TestCase):
     def setUp(self):
-        self.docs = {
-                    'foo' : [1, 2, 3, 4, 5],
-                    'bar' : [2, 3, 7, 8, 9],
-                    'baz' : [1, 2, 7],
-                    'alone' : [6, 10]
-                }
-
-        class IndexerMock:
-            document_count = 10
-            def get_title(self, doc):
-                return doc
-
-            def get_posting(self2, term):
-                return self.docs[term]
-
-            def normalize(self, term):
-                return [term]
-
-        self.searcher = Searcher(IndexerMock())
+        self.searcher = Searcher(mock_index(self))
 
     def test_single(self):
         query = Query('foo')
@@ -447,5 +695,268 @@ class SearcherTest(unittest.TestCase):
         res = self.searcher.search(query)
         self.assertEqual(list(res), [])
 
+    def test_clause_order(self):
+        query = Query('~alone|foo bar|foo baz')
+        self.assertEqual([self.searcher.estimate_clause(c) for c in query.clauses], [10, 10, 3])
+        res = self.searcher.search(query)
+        self.assertEqual(list(res), [1, 2, 7])
+        self.assertEqual(self.fetched[0], 'baz')
+
+    def test_empty_intersection_stops(self):
+        query = Query('foo|baz alone bar')
+        res = self.searcher.search(query)
+        self.assertEqual(list(res), [])
+        self.assertEqual(self.fetched, ['alone', 'bar'])
+
+    def test_negation_deleted(self):
+        self.searcher.indexer.deleted = [4, 9]
+        query = Query('~foo')
+        res = self.searcher.search(query)
+        self.assertEqual(list(res), [6, 7, 8, 10])
+
+    def test_count(self):
+        self.assertEqual(self.searcher.count(Query('foo|bar')), 8)
+        self.assertEqual(self.searcher.count(Query('~foo ~bar')), 2)
+        self.assertEqual(self.searcher.count(Query('~alone|~foo')), 10)
+
+    def test_page(self):
+        docs = self.searcher.search(Query('~alone'))
+        self.assertEqual(Searcher.page(docs, 0, 3), [1, 2, 3])
+        self.assertEqual(Searcher.page(docs, 5), [7, 8, 9])
+        self.assertEqual(Searcher.page(docs, 2, 0), [])
+        self.assertEqual(Searcher.total(docs), 8)
+
+    def test_total_page(self):
+        self.assertEqual(Searcher.total_page(iter(range(1, 11)), 2, 3), (10, [3, 4, 5]))
+        self.assertEqual(Searcher.total_page(iter(range(1, 11)), 8), (10, [9, 10]))
+        self.assertEqual(Searcher.total_page(iter(range(1, 11)), 20, 3), (10, []))
+        self.assertEqual(Searcher.total_page(iter(range(1, 11)), 0, 0), (10, []))
+        self.assertEqual(Searcher.total_page([1, 2, 3], 1, 1), (3, [2]))
+
+    def test_lazy_page(self):
+        query = Query('foo|bar')
+        docs = self.searcher.search(query, 2)
+        # only the results kept whole anyway (like bitmaps) are cached
+        self.assertEqual(self.searcher.cached(query), materialized(docs))
+        self.assertEqual(Searcher.total_page(docs, 0, 2), (8, [1, 2]))
+        self.assertEqual(list(self.searcher.search(query)), [1, 2, 3, 4, 5, 7, 8, 9])
+        self.assertTrue(self.searcher.cached(query))
+        self.assertEqual(list(self.searcher.search(query, 2)), [1, 2, 3, 4, 5, 7, 8, 9])
+
+    def test_wildcard(self):
+        self.assertEqual(list(self.searcher.search(Query('ba*'))), [1, 2, 3, 7, 8, 9])
+        self.assertEqual(list(self.searcher.search(Query('ba* ~foo'))), [7, 8, 9])
+        self.assertEqual(list(self.searcher.search(Query('~ba*|alone'))), [4, 5, 6, 10])
+        self.assertEqual(list(self.searcher.search(Query('x*|alone'))), [6, 10])
+        self.assertEqual(self.searcher.count(Query('*')), 10)
+        self.searcher.max_expansions = 1
+        self.searcher.results.clear()
+        self.assertEqual(list(self.searcher.search(Query('ba*'))), [2, 3, 7, 8, 9])
+
+    def test_huge_complement(self):
+        self.searcher.indexer.document_count = 10 ** 12
+        query = Query('~foo|~alone')
+        self.assertEqual(self.searcher.count(query), 10 ** 12)
+        res = self.searcher.search(Query('~foo'))
+        self.assertEqual(list(itertools.islice(res, 3)), [6, 7, 8])
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.searcher = Searcher(mock_index(self))
+
+    def test_equivalent_queries(self):
+        self.assertEqual(list(self.searcher.search(Query('foo|baz bar'))), [2, 3, 7])
+        fetched = len(self.fetched)
+        self.assertEqual(list(self.searcher.search(Query('bar baz|foo'))), [2, 3, 7])
+        self.assertEqual(list(self.searcher.search(Query('bar bar baz|foo'))), [2, 3, 7])
+        self.assertEqual(len(self.fetched), fetched)
+        self.assertEqual(self.searcher.results.stats()['hits'], 2)
+
+    def test_negation(self):
+        self.assertEqual(list(self.searcher.search(Query('~foo'))), [6, 7, 8, 9, 10])
+        self.searcher.indexer.deleted = [7]
+        self.searcher.indexer.segments_version = 1
+        self.assertEqual(list(self.searcher.search(Query('~foo'))), [6, 8, 9, 10])
+
+    def test_invalidation(self):
+        self.assertTrue(not self.searcher.cached(Query('foo')))
+        self.assertEqual(list(self.searcher.search(Query('foo'))), [1, 2, 3, 4, 5])
+        self.assertTrue(self.searcher.cached(Query('foo')))
+        self.docs['foo'] = [1, 2]
+        self.searcher.indexer.segments_version = 1
+        self.assertTrue(not self.searcher.cached(Query('foo')))
+        self.assertEqual(list(self.searcher.search(Query('foo'))), [1, 2])
+
+class BatchSearcherTest(unittest.TestCase):
+    def setUp(self):
+        self.searcher = Searcher(mock_index(self))
+
+    def test_shared(self):
+        queries = [Query(q) for q in ['foo|bar baz', 'bar|foo ~alone',
+            '~baz alone|foo', 'alone']]
+        results = [list(docs) for docs in self.searcher.search_batch(queries)]
+        self.assertEqual(results, [[1, 2, 7], [1, 2, 3, 4, 5, 7, 8, 9],
+            [3, 4, 5, 6, 10], [6, 10]])
+        self.assertEqual(sorted(self.fetched), ['alone', 'bar', 'baz', 'foo'])
+        self.assertEqual(self.searcher.batch_results, {})
+
+    def test_shared_clause(self):
+        queries = [Query('foo|bar baz'), Query('bar|foo alone'), Query('~foo|bar')]
+        self.searcher.search_batch(queries)
+        self.assertEqual(sorted(self.fetched), ['alone', 'bar', 'baz', 'foo'])
+        self.fetched = []
+        self.searcher.results.clear()
+        for query in queries:
+            self.searcher.search(query)
+        self.assertEqual(sorted(self.fetched), ['alone', 'bar', 'bar', 'bar',
+            'baz', 'foo', 'foo', 'foo'])
+
+class IndexSearcherTest(unittest.TestCase):
+    '''Searches an index written to a temporary directory'''
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.indexer = indexer.Indexer(index_dir = self.index_dir)
+        self.searcher = Searcher(self.indexer)
+
+    def tearDown(self):
+        self.indexer.close()
+        shutil.rmtree(self.index_dir)
+
+    def write_index(self, postings, document_count):
+        '''Writes the (term, positional posting) pairs as the index'''
+        self.indexer.write_index(iter(postings), self.index_dir)
+        self.indexer.document_count = document_count
+
+    def test_empty_word(self):
+        self.write_index([('kot', [(1, [1]), (3, [2])])], 3)
+        self.assertEqual(list(self.searcher.search(Query('~'))), [1, 2, 3])
+        self.assertEqual(list(self.searcher.search(Query('~kot'))), [2])
+
+    def test_cached_bitmap(self):
+        docs = list(range(1, 2 * codec.BLOCK_SIZE + 1))
+        self.write_index([('kot', [(doc, [1]) for doc in docs])], len(docs))
+        bitmap = compact(self.indexer.get_posting('kot'))
+        self.assertTrue(isinstance(bitmap, posting.Bitmap))
+        self.assertEqual(list(self.searcher.search(Query('kot'))), docs)
+        # the cached results must not pin the mapped partition
+        self.indexer.segments_version = None
+        self.indexer.refresh()
+        self.indexer.close()
+        self.assertEqual(list(bitmap), docs)
+        self.assertEqual(list(self.searcher.search(Query('kot'))), docs)
+
+@unittest.skipIf(vectorized.numpy is None, "NumPy is not installed")
+class NumpySearcherTest(SearcherTest):
+    def setUp(self):
+        SearcherTest.setUp(self)
+        self.searcher = Searcher(self.searcher.indexer, backend = 'numpy')
+
+class PhraseSearcherTest(unittest.TestCase):
+    def setUp(self):
+        documents = {1: 'rada miasto w kraków', 2: 'w kraków rada',
+                3: 'miasto w warszawa w kraków'}
+        self.positional = {}
+        for doc, text in sorted(documents.items()):
+            words = text.split(' ')
+            for pos, word in enumerate(words, 1):
+                self.positional.setdefault(word, {}).setdefault(doc, []).append(pos)
+                if pos < len(words) and 'w' in (word, words[pos]):
+                    biword = word + ' ' + words[pos]
+                    self.positional.setdefault(biword, {}).setdefault(doc, []).append(pos)
+        self.fetched = []
+        self.frequent = set(['w'])
+        self.bases = {}
+
+        class IndexerMock:
+            segments_version = None
+            def get_positional_posting(self2, term):
+                self.fetched.append(term)
+                return iter(sorted(self.positional.get(term, {}).items()))
+
+            def get_frequent(self2):
+                return self.frequent
+
+            def normalize(self2, term):
+                return self.bases.get(term, [term])
+
+        self.searcher = Searcher(IndexerMock())
+
+    def search(self, query):
+        return list(self.searcher.search(Query(query)))
+
+    def check_phrases(self):
+        self.assertEqual(self.search('"rada miasto w kraków"'), [1])
+        self.assertEqual(self.search('"miasto w kraków"'), [1])
+        self.assertEqual(self.search('"w kraków"'), [1, 2, 3])
+        self.assertEqual(self.search('"warszawa w kraków"'), [3])
+        self.assertEqual(self.search('"kraków rada"'), [2])
+
+    def test_biwords(self):
+        self.check_phrases()
+        self.assertFalse('w' in self.fetched)
+        self.assertTrue('miasto w' in self.fetched)
+        self.assertEqual(self.search('"w"'), [1, 2, 3])
+
+    def test_no_biwords(self):
+        self.frequent = set()
+        self.check_phrases()
+        self.assertFalse('miasto w' in self.fetched)
+
+    def test_alternatives(self):
+        self.frequent = set()
+        self.bases = {'miejsce': ['miasto', 'warszawa'], 'gród': ['kraków', 'rada']}
+        self.assertEqual(self.search('"miejsce w gród"'), [1, 3])
+        self.assertEqual(self.search('"gród miejsce"'), [1])
+        self.assertEqual(self.search('"gród gród"'), [2])
+
+    def test_match_phrase(self):
+        match = self.searcher.match_phrase
+        self.assertTrue(match([0, 1], [[[1, 5, 9]], [[3], [10]]]))
+        self.assertFalse(match([0, 1], [[[1, 5, 9]], [[3], [8]]]))
+        self.assertTrue(match([0, 2, 3], [[[2, 4]], [[6, 7]], [[3, 7]]]))
+        self.assertFalse(match([0, 2], [[[]], [[2]]]))
+
+class BitmapSearcherTest(SearcherTest):
+    def setUp(self):
+        SearcherTest.setUp(self)
+        get_posting = self.searcher.indexer.get_posting
+        def get_bitmap_posting(term):
+            if term in ('foo', 'bar'):
+                return posting.to_bitmap(get_posting(term))
+            return get_posting(term)
+        self.searcher.indexer.get_posting = get_bitmap_posting
+
+    def test_bitmap_negation(self):
+        query = Query('~foo|~bar')
+        res = self.searcher.search(query)
+        self.assertTrue(isinstance(res, posting.Bitmap))
+        self.assertEqual(list(res), [1, 4, 5, 6, 7, 8, 9, 10])
+
+class BlockSearcherTest(SearcherTest):
+    def setUp(self):
+        SearcherTest.setUp(self)
+        get_posting = self.searcher.indexer.get_posting
+        def get_block_posting(term):
+            return posting.BlockPosting(codec.encode(get_posting(term)))
+        self.searcher.indexer.get_posting = get_block_posting
+
+    def test_gallop(self):
+        self.docs['long'] = list(range(1, 100000, 3))
+        self.docs['short'] = [4, 5, 30001, 99997, 99999]
+        query = Query('short long')
+        res = self.searcher.search(query)
+        self.assertEqual(list(res), [4, 30001, 99997])
+
+    def test_subtract_tail(self):
+        query = Query('bar ~baz')
+        res = self.searcher.search(query)
+        self.assertEqual(list(res), [3, 8, 9])
+
+@unittest.skipIf(vectorized.numpy is None, "NumPy is not installed")
+class NumpyPhraseSearcherTest(PhraseSearcherTest):
+    def setUp(self):
+        PhraseSearcherTest.setUp(self)
+        self.searcher = Searcher(self.searcher.indexer, backend = 'numpy')
+
 if __name__ == "__main__":
     unittest.main()
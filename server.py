@@ -0,0 +1,247 @@
+#!/usr/bin/python3.1 -OO
+'''File for the query server keeping the index warm between requests and tests for it'''
+import unittest
+import asyncio
+import concurrent.futures
+import json
+import os
+import tempfile
+import threading
+import searcher
+
+class QueryServer:
+    """Answers the queries of many clients with one warm index.
+
+    A client sends one query per line, either as plain text (answered like in
+    the batch mode with the default page, the answer ends with an empty line)
+    or as a JSON object with a "query" key and optional "offset" and "limit"
+    keys (answered with one JSON line). Every client has at most one query in
+    flight. The queries wait in a bounded queue, over the bound they are
+    refused at once, and the worker threads answer them in batches with
+    run_batch, which gets the queries and their (offset, limit) pages and
+    returns the number of the documents found and the page of titles for
+    every query. A failing batch is answered again query by query, so only
+    the clients of the failing queries get an error.
+
+    The index is not thread safe, so by default there is one worker and a
+    slow query delays the ones queued after it. More workers take the
+    following batches meanwhile, but then run_batch has to be safe to call
+    from many threads, like the one of a QueryPool."""
+    def __init__(self, run_batch, max_pending = 64, batch_size = 50,
+            page = (0, None), workers = 1):
+        self.run_batch = run_batch
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.page = page
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.queue = None
+
+    async def serve(self, path = None, host = 'localhost', port = None):
+        '''Listens on a Unix socket (if the path is given) or a TCP port'''
+        self.queue = asyncio.Queue(self.max_pending)
+        workers = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle_client, path)
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def work(self):
+        '''Answers the queued queries in batches'''
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            await self.answer_batch(batch)
+
+    async def answer_batch(self, batch):
+        '''Sets the results of the ((query, page), future) pairs of a batch,
+        answering the queries one by one if the batch fails'''
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor,
+                    self.run_batch, [query for (query, _), _ in batch],
+                    [page for (_, page), _ in batch])
+        except Exception as error: #pylint: disable=W0703
+            if len(batch) > 1:
+                for item in batch:
+                    await self.answer_batch([item])
+            elif not batch[0][1].done():
+                batch[0][1].set_exception(error)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def handle_client(self, reader, writer):
+        '''Answers the queries of a client until it disconnects'''
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8').strip()
+                if line != '':
+                    writer.write(await self.answer(line))
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def answer(self, line):
+        '''Returns the encoded answer to a request line'''
+        as_json = line[0] == '{'
+        page = self.page
+        try:
+            if as_json:
+                request = json.loads(line)
+                query = searcher.Query(request['query'])
+                page = (request.get('offset', 0), request.get('limit'))
+            else:
+                query = searcher.Query(line)
+        except (ValueError, KeyError, TypeError, AttributeError, IndexError,
+                searcher.EmptyQuery):
+            query = None
+        if (query is None or query.type == "" or not isinstance(page[0], int)
+                or page[0] < 0 or not (page[1] is None or
+                    isinstance(page[1], int) and page[1] >= 0)):
+            return QueryServer.format_error(as_json, 'bad query')
+
+        if self.queue.full():
+            return QueryServer.format_error(as_json, 'busy')
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(((query, page), future))
+        try:
+            total, titles = await future
+        except Exception: #pylint: disable=W0703
+            return QueryServer.format_error(as_json, 'search failed')
+
+        if as_json:
+            return (json.dumps({'query': str(query), 'total': total,
+                'titles': titles}) + '\n').encode('utf-8')
+        return ('QUERY: %(query)s TOTAL: %(total)d\n' % {'query': query,
+            'total': total} + ''.join(title + '\n' for title in titles)
+            + '\n').encode('utf-8')
+
+    @staticmethod
+    def format_error(as_json, message):
+        '''Returns the encoded answer for a refused request'''
+        if as_json:
+            return (json.dumps({'error': message}) + '\n').encode('utf-8')
+        return ('ERROR: %(message)s\n\n' % {'message': message}).encode('utf-8')
+
+def serve(run_batch, path = None, host = 'localhost', port = None, max_pending = 64,
+        page = (0, None), workers = 1):
+    '''Runs a query server until interrupted'''
+    try:
+        asyncio.run(QueryServer(run_batch, max_pending, page = page,
+            workers = workers).serve(path, host, port))
+    except KeyboardInterrupt:
+        pass
+
+class QueryServerTest(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.slow = threading.Event()
+        def run_batch(queries, pages):
+            self.batches.append(queries)
+            results = []
+            for query, (offset, limit) in zip(queries, pages):
+                if 'bad' in query.get_words():
+                    raise IndexError()
+                if 'slow' in query.get_words():
+                    self.slow.wait(5)
+                titles = ['Doc ' + word for word in query.get_words()]
+                end = None if limit is None else offset + limit
+                results.append((len(titles), titles[offset:end]))
+            return results
+        self.server = QueryServer(run_batch, max_pending = 2)
+
+    def test_clients(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'socket')
+
+        async def client(lines):
+            reader, writer = await asyncio.open_unix_connection(path)
+            answers = []
+            for line in lines:
+                writer.write(line.encode('utf-8') + b'\n')
+                answers.append(await reader.readline())
+                if line[0] != '{':
+                    while answers[-1][-2:] != b'\n\n':
+                        answers[-1] += await reader.readline()
+            writer.close()
+            return [answer.decode('utf-8') for answer in answers]
+
+        async def run():
+            serving = asyncio.ensure_future(self.server.serve(path))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            answers = await asyncio.gather(client(['foo bar', '{"query": "baz"}',
+                '{"query": "a b c", "offset": 1, "limit": 1}']),
+                client(['{"query": ""}', '""', '"kot pies"', '{"query": "a", "limit": -1}',
+                    '{"query": "a|"}']))
+            serving.cancel()
+            return answers
+
+        try:
+            first, second = asyncio.run(run())
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+            os.rmdir(directory)
+        self.assertEqual(first, ['QUERY: foo bar TOTAL: 2\nDoc foo\nDoc bar\n\n',
+            '{"query": "baz", "total": 1, "titles": ["Doc baz"]}\n',
+            '{"query": "a b c", "total": 3, "titles": ["Doc b"]}\n'])
+        self.assertEqual(second, ['{"error": "bad query"}\n', 'ERROR: bad query\n\n',
+            'QUERY: "kot pies" TOTAL: 2\nDoc kot\nDoc pies\n\n',
+            '{"error": "bad query"}\n', '{"error": "bad query"}\n'])
+
+    def test_failing_query(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            batch = [((searcher.Query(line), (0, None)), loop.create_future())
+                    for line in ['foo', 'bad|foo', 'bar']]
+            await self.server.answer_batch(batch)
+            return [future.exception() or future.result() for _, future in batch]
+        first, failed, last = asyncio.run(run())
+        self.assertEqual(first, (1, ['Doc foo']))
+        self.assertTrue(isinstance(failed, IndexError))
+        self.assertEqual(last, (1, ['Doc bar']))
+        self.assertEqual(len(self.batches), 4)
+
+    def test_slow_query(self):
+        self.server = QueryServer(self.server.run_batch, workers = 2)
+
+        async def run():
+            self.server.queue = asyncio.Queue(self.server.max_pending)
+            workers = [asyncio.ensure_future(self.server.work()) for _ in range(2)]
+            slow = asyncio.ensure_future(self.server.answer('slow'))
+            await asyncio.sleep(0.05)
+            fast = await self.server.answer('foo')
+            done = slow.done()
+            self.slow.set()
+            await slow
+            for worker in workers:
+                worker.cancel()
+            return fast, done
+        fast, done = asyncio.run(run())
+        self.assertEqual(fast, b'QUERY: foo TOTAL: 1\nDoc foo\n\n')
+        self.assertFalse(done)
+
+    def test_busy(self):
+        async def run():
+            self.server.queue = asyncio.Queue(self.server.max_pending)
+            self.server.queue.put_nowait(None)
+            self.server.queue.put_nowait(None)
+            return await self.server.answer('foo')
+        self.assertEqual(asyncio.run(run()), b'ERROR: busy\n\n')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/python3.1 -OO
+'''File for the stage timing and I/O counters of the searches and tests for them'''
+import unittest
+import contextlib
+import time
+
+class Stats:
+    """Wall time of the stages, counters and touched files of a query or a batch.
+
+    With the cache_stats function given (returning the counters of the
+    caches by name) the report also has the cache hits and misses since the
+    creation of the object."""
+    def __init__(self, cache_stats = None):
+        self.stages = {}
+        self.counters = {}
+        self.notes = {}
+        self.cache_stats = cache_stats
+        self.caches = cache_stats() if cache_stats is not None else {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Adds the wall time of the block to a stage'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def add(self, name, value = 1):
+        '''Adds a value to a counter'''
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def note(self, name, item):
+        '''Adds an item to a set, like the files touched'''
+        self.notes.setdefault(name, set()).add(item)
+
+    def merge(self, other):
+        '''Adds the stages, the counters and the notes of other stats'''
+        for name, seconds in other.stages.items():
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        for name, value in other.counters.items():
+            self.add(name, value)
+        for name, items in other.notes.items():
+            self.notes.setdefault(name, set()).update(items)
+
+    def report(self):
+        '''Returns the stats as a dictionary that can be dumped as JSON'''
+        res = {'stages': dict(self.stages), 'counters': dict(self.counters)}
+        for name, items in self.notes.items():
+            res[name] = sorted(items)
+        if self.cache_stats is not None:
+            res['caches'] = {}
+            for name, counters in self.cache_stats().items():
+                before = self.caches.get(name, {'hits': 0, 'misses': 0})
+                hits = counters['hits'] - before['hits']
+                misses = counters['misses'] - before['misses']
+                res['caches'][name] = {'hits': hits, 'misses': misses,
+                        'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+        return res
+
+class DisabledStats:
+    '''Stats recording nothing, used when the instrumentation is off'''
+    def __init__(self):
+        self.null_stage = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self.null_stage
+
+    def add(self, name, value = 1):
+        pass
+
+    def note(self, name, item):
+        pass
+
+    def merge(self, other):
+        pass
+
+DISABLED = DisabledStats()
+
+class StatsTest(unittest.TestCase):
+    def test_report(self):
+        counters = {'postings': {'hits': 1, 'misses': 2}}
+        stats = Stats(lambda: counters)
+        with stats.stage('search'):
+            stats.add('bytes_read', 100)
+            stats.add('bytes_read', 28)
+            stats.note('prefix_files', 'kot')
+            stats.note('prefix_files', 'ala')
+            stats.note('prefix_files', 'kot')
+        counters = {'postings': {'hits': 4, 'misses': 3}, 'results': {'hits': 0, 'misses': 1}}
+        report = stats.report()
+        self.assertEqual(list(report['stages']), ['search'])
+        self.assertEqual(report['counters'], {'bytes_read': 128})
+        self.assertEqual(report['prefix_files'], ['ala', 'kot'])
+        self.assertEqual(report['caches'], {'postings': {'hits': 3, 'misses': 1,
+            'hit_rate': 0.75}, 'results': {'hits': 0, 'misses': 1, 'hit_rate': 0.0}})
+
+    def test_merge(self):
+        batch = Stats()
+        batch.add('entries_read')
+        query = Stats()
+        query.add('entries_read', 2)
+        query.note('prefix_files', 'kot')
+        with query.stage('titles'):
+            pass
+        batch.merge(query)
+        self.assertEqual(batch.report()['counters'], {'entries_read': 3})
+        self.assertEqual(batch.report()['prefix_files'], ['kot'])
+        self.assertTrue('titles' in batch.report()['stages'])
+
+    def test_disabled(self):
+        with DISABLED.stage('search'):
+            DISABLED.add('bytes_read', 10)
+            DISABLED.note('prefix_files', 'kot')
+        DISABLED.merge(Stats())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/python3.1 -OO
+'''File for the memory mapped sorted term dictionary and tests for it'''
+import unittest
+import array
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+MAGIC = b'BST1'
+HEADER = struct.Struct('<4sI')
+KEY_OFFSET = struct.Struct('<I')
+VALUE_OFFSET = struct.Struct('<Q')
+KEY_OFFSETS = 'I' if array.array('I').itemsize == 4 else 'L'
+
+def write_dictionary(filename, items):
+    """Writes a term dictionary file from (term, value bytes) pairs.
+
+    The terms have to be sorted by their UTF-8 encoding (as LC_ALL=C sort
+    does). The file has a header, a table of term offsets, a table of value
+    offsets, the terms and the values. The terms and the values are spooled
+    to temporary files, so only the offset tables are kept in memory."""
+    key_offsets = array.array(KEY_OFFSETS, [0])
+    value_offsets = array.array('Q', [0])
+    directory = os.path.dirname(filename) or '.'
+    with tempfile.TemporaryFile(dir = directory) as keys, \
+            tempfile.TemporaryFile(dir = directory) as values:
+        for term, value in items:
+            key = term.encode('utf-8')
+            keys.write(key)
+            values.write(value)
+            key_offsets.append(key_offsets[-1] + len(key))
+            value_offsets.append(value_offsets[-1] + len(value))
+
+        if sys.byteorder == 'big':
+            key_offsets.byteswap()
+            value_offsets.byteswap()
+        with open(filename, 'wb') as handle:
+            handle.write(HEADER.pack(MAGIC, len(key_offsets) - 1))
+            handle.write(key_offsets.tobytes())
+            handle.write(value_offsets.tobytes())
+            for spooled in (keys, values):
+                spooled.seek(0)
+                shutil.copyfileobj(spooled, handle)
+
+class TermDictionary:
+    '''A read only, memory mapped term dictionary with binary search lookups'''
+    def __init__(self, filename):
+        with open(filename, 'rb') as handle:
+            self.map = mmap.mmap(handle.fileno(), 0, access = mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        magic, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise Exception("%s is not a term dictionary" % filename)
+        self.key_table = HEADER.size
+        self.value_table = self.key_table + KEY_OFFSET.size * (self.count + 1)
+        self.keys_start = self.value_table + VALUE_OFFSET.size * (self.count + 1)
+        self.values_start = (self.keys_start +
+                KEY_OFFSET.unpack_from(self.map, self.value_table - KEY_OFFSET.size)[0])
+
+    def __len__(self):
+        return self.count
+
+    def key(self, i):
+        '''Returns the encoded term number i'''
+        start, end = struct.unpack_from('<II', self.map,
+                self.key_table + KEY_OFFSET.size * i)
+        return self.map[self.keys_start + start:self.keys_start + end]
+
+    def value(self, i):
+        '''Returns a zero-copy view of the value number i'''
+        start, end = struct.unpack_from('<QQ', self.map,
+                self.value_table + VALUE_OFFSET.size * i)
+        return self.view[self.values_start + start:self.values_start + end]
+
+    def find(self, term):
+        '''Returns the number of the first term >= the given one'''
+        key = term.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get(self, term, default = None):
+        '''Returns a view of the value stored for a term'''
+        i = self.find(term)
+        if i < self.count and self.key(i) == term.encode('utf-8'):
+            return self.value(i)
+        return default
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def close(self):
+        '''Unmaps the dictionary file'''
+        self.view.release()
+        self.map.close()
+
+class TermDictionaryTest(unittest.TestCase):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp()
+        os.close(handle)
+        terms = sorted(['ala', 'kot', 'ma', 'żubr', 'zamek', 'a'], key = lambda t: t.encode('utf-8'))
+        write_dictionary(self.filename, [(t, t.upper().encode('utf-8')) for t in terms])
+        self.dictionary = TermDictionary(self.filename)
+
+    def tearDown(self):
+        self.dictionary.close()
+        os.remove(self.filename)
+
+    def test_get(self):
+        self.assertEqual(len(self.dictionary), 6)
+        self.assertEqual(bytes(self.dictionary.get('kot')), b'KOT')
+        self.assertEqual(bytes(self.dictionary.get('żubr')), 'ŻUBR'.encode('utf-8'))
+        self.assertEqual(bytes(self.dictionary.get('a')), b'A')
+        self.assertEqual(self.dictionary.get('pies'), None)
+        self.assertFalse('zz' in self.dictionary)
+
+    def test_find(self):
+        self.assertEqual(self.dictionary.find(''), 0)
+        self.assertEqual(self.dictionary.key(self.dictionary.find('b')), b'kot')
+        self.assertEqual(self.dictionary.find('zzz'), 5)
+
+if __name__ == "__main__":
+    unittest.main()
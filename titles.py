@@ -0,0 +1,123 @@
+#!/usr/bin/python3.1 -OO
+'''File for the memory mapped store of the document titles and tests for it'''
+import unittest
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+MAGIC = b'TTL1'
+HEADER = struct.Struct('<4sIHH')
+BLOCK_OFFSET = struct.Struct('<Q')
+BLOCK_SIZE = 64
+# flag set in the header when the blocks are zlib compressed
+COMPRESSED = 1
+
+def write_titles(filename, titles, compressed = False):
+    """Writes a titles store file from a list of titles.
+
+    The titles are stored in blocks of BLOCK_SIZE, joined with newlines and
+    possibly zlib compressed. The file has a header (with the number of
+    titles), a table of block offsets and the blocks."""
+    blocks = []
+    for start in range(0, len(titles), BLOCK_SIZE):
+        block = '\n'.join(titles[start:start + BLOCK_SIZE]).encode('utf-8')
+        if compressed:
+            block = zlib.compress(block)
+        blocks.append(block)
+
+    offsets = [0]
+    for block in blocks:
+        offsets.append(offsets[-1] + len(block))
+
+    with open(filename, 'wb') as handle:
+        handle.write(HEADER.pack(MAGIC, len(titles), BLOCK_SIZE,
+            COMPRESSED if compressed else 0))
+        handle.write(b''.join(BLOCK_OFFSET.pack(off) for off in offsets))
+        for block in blocks:
+            handle.write(block)
+
+class TitleStore:
+    '''A read only, memory mapped store of titles decoding one block at a time'''
+    def __init__(self, filename):
+        with open(filename, 'rb') as handle:
+            self.map = mmap.mmap(handle.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, self.count, self.block_size, flags = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise Exception("%s is not a titles store" % filename)
+        self.compressed = flags & COMPRESSED
+        block_count = (self.count + self.block_size - 1) // self.block_size
+        self.blocks_start = HEADER.size + BLOCK_OFFSET.size * (block_count + 1)
+        # the last decoded block, the titles are mostly read in order
+        self.block_no = None
+        self.block = None
+
+    def __len__(self):
+        return self.count
+
+    def get_block(self, block_no):
+        '''Returns the titles of a block'''
+        if block_no != self.block_no:
+            start, end = struct.unpack_from('<QQ', self.map,
+                    HEADER.size + BLOCK_OFFSET.size * block_no)
+            data = self.map[self.blocks_start + start:self.blocks_start + end]
+            if self.compressed:
+                data = zlib.decompress(data)
+            self.block = data.decode('utf-8').split('\n')
+            self.block_no = block_no
+        return self.block
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.get_block(i // self.block_size)[i % self.block_size]
+
+    def __iter__(self):
+        for block_no in range(0, (self.count + self.block_size - 1) // self.block_size):
+            for title in self.get_block(block_no):
+                yield title
+
+    def close(self):
+        '''Unmaps the store file'''
+        self.map.close()
+
+class TitleStoreTest(unittest.TestCase):
+    def check(self, compressed):
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        titles = ['Tytuł %(no)d' % {'no': no} for no in range(150)] + ['']
+        try:
+            write_titles(filename, titles, compressed)
+            store = TitleStore(filename)
+            self.assertEqual(len(store), 151)
+            self.assertEqual(store[0], 'Tytuł 0')
+            self.assertEqual(store[130], 'Tytuł 130')
+            self.assertEqual(store[64], 'Tytuł 64')
+            self.assertEqual(store[150], '')
+            self.assertRaises(IndexError, lambda: store[151])
+            self.assertEqual(list(store), titles)
+            store.close()
+        finally:
+            os.remove(filename)
+
+    def test_plain(self):
+        self.check(False)
+
+    def test_compressed(self):
+        self.check(True)
+
+    def test_empty(self):
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            write_titles(filename, [])
+            store = TitleStore(filename)
+            self.assertEqual(len(store), 0)
+            self.assertEqual(list(store), [])
+            store.close()
+        finally:
+            os.remove(filename)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python3.1 -OO
+'''File for the NumPy kernels of the vectorized search backend and tests for them'''
+import unittest
+import array
+import posting
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def to_array(docs):
+    '''Returns a sorted document list as a NumPy array of 64 bit integers'''
+    if isinstance(docs, numpy.ndarray):
+        return docs
+    if isinstance(docs, posting.Bitmap):
+        bits = numpy.unpackbits(numpy.frombuffer(docs.data, dtype = numpy.uint8),
+                bitorder = 'little')
+        return numpy.flatnonzero(bits).astype(numpy.int64) + (docs.base << 3)
+    if isinstance(docs, posting.Posting):
+        docs = docs.docs
+    if isinstance(docs, (list, array.array, memoryview)):
+        return numpy.asarray(docs, dtype = numpy.int64)
+    return numpy.fromiter(docs, dtype = numpy.int64)
+
+def members(docs, sorted_docs):
+    '''Returns the mask of the documents present in a sorted array, found
+    with a binary search for all of them at once'''
+    if len(sorted_docs) == 0:
+        return numpy.zeros(len(docs), dtype = bool)
+    found = numpy.searchsorted(sorted_docs, docs)
+    found[found == len(sorted_docs)] = 0
+    return sorted_docs[found] == docs
+
+def intersection(docs1, docs2):
+    '''And-merges two document lists, searching the shorter one in the longer'''
+    docs1 = to_array(docs1)
+    docs2 = to_array(docs2)
+    if len(docs1) > len(docs2):
+        docs1, docs2 = docs2, docs1
+    return docs1[members(docs1, docs2)]
+
+def union(docs1, docs2):
+    '''Or-merges two document lists'''
+    return numpy.union1d(to_array(docs1), to_array(docs2))
+
+def union_all(doc_lists):
+    '''Or-merges any number of document lists at once'''
+    if len(doc_lists) == 0:
+        return numpy.zeros(0, dtype = numpy.int64)
+    return numpy.unique(numpy.concatenate([to_array(docs) for docs in doc_lists]))
+
+def difference(docs1, docs2):
+    '''Subtracts two document lists'''
+    docs1 = to_array(docs1)
+    return docs1[~members(docs1, to_array(docs2))]
+
+def match_phrase(offsets, positions):
+    """Checks whether the pieces of a phrase occur at their offsets in a document.
+
+    The positions of the alternatives of every piece are merged, then the
+    candidate starts of the phrase (from the first piece) are filtered by
+    every following piece shifted by its offset."""
+    starts = None
+    for offset, lists in zip(offsets, positions):
+        piece = numpy.unique(numpy.concatenate([to_array(p) for p in lists]))
+        if starts is None:
+            starts = piece - offset
+        else:
+            starts = starts[members(starts + offset, piece)]
+        if len(starts) == 0:
+            return False
+    return True
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class VectorizedTest(unittest.TestCase):
+    def test_to_array(self):
+        bitmap = posting.to_bitmap([1, 9, 70])
+        self.assertEqual(to_array(bitmap).tolist(), [1, 9, 70])
+        self.assertEqual(to_array(posting.to_bitmap([801, 900])).tolist(), [801, 900])
+        self.assertEqual(to_array(posting.Posting(array.array('I', [2, 3]))).tolist(), [2, 3])
+        self.assertEqual(to_array(iter([4, 5])).tolist(), [4, 5])
+        self.assertEqual(to_array([]).tolist(), [])
+
+    def test_kernels(self):
+        docs1 = [1, 3, 5, 7, 9, 100]
+        docs2 = [2, 3, 4, 9, 101]
+        self.assertEqual(intersection(docs1, docs2).tolist(), [3, 9])
+        self.assertEqual(union(docs1, docs2).tolist(), sorted(set(docs1) | set(docs2)))
+        self.assertEqual(difference(docs1, docs2).tolist(), [1, 5, 7, 100])
+        self.assertEqual(difference(docs1, []).tolist(), docs1)
+        self.assertEqual(intersection([], docs2).tolist(), [])
+        self.assertEqual(union_all([docs1, docs2, [0, 3]]).tolist(),
+                sorted(set(docs1) | set(docs2) | {0}))
+        self.assertEqual(union_all([]).tolist(), [])
+
+    def test_match_phrase(self):
+        self.assertTrue(match_phrase([0, 1], [[[1, 5, 9]], [[3], [10]]]))
+        self.assertFalse(match_phrase([0, 1], [[[1, 5, 9]], [[3], [8]]]))
+        self.assertTrue(match_phrase([0, 2, 3], [[[2, 4]], [[6, 7]], [[3, 7]]]))
+        self.assertFalse(match_phrase([0, 2], [[[]], [[2]]]))
+
+if __name__ == "__main__":
+    unittest.main()